@@ -1,12 +1,13 @@
 # pylint: disable=missing-module-docstring,missing-function-docstring
 import os
 import datetime
-from time import time
+import gzip
 
 from bson import ObjectId
 from bson.json_util import dumps
 from flask import (
     Flask,
+    g,
     request,
     make_response,
     render_template,
@@ -15,9 +16,18 @@ from flask import (
     url_for,
     flash,
     Response,
+    stream_with_context,
 )
 
+import badges
+import export
+import feed
 import helper
+import indexes
+import metrics
+import receipts
+import request_profiler
+import sync
 
 app = Flask(__name__)
 if os.path.isfile(".env"):  # for local testing
@@ -28,6 +38,105 @@ if os.path.isfile(".env"):  # for local testing
 else:
     app.secret_key = os.environ["SECRET_KEY"]
 
+GZIP_MIN_SIZE = 500  # Smallest API response, in bytes, that is compressed
+
+if os.getenv("ENSURE_INDEXES"):
+    for name, message in indexes.ensure_indexes(helper.db).items():
+        print(f"Could not create index {name}: {message}")
+
+
+def helper_metrics() -> list:
+    """Reports the statistics of the caches and buffers in helper.py, for metrics.py
+
+    Returns:
+        A list containing tuples in the form of (name, help, labels, value)
+    """
+    gauges = []
+    for cache_name, cache in (
+        ("membership", feed.membership_cache),
+        ("user_name", feed.user_name_cache),
+        ("group_name", feed.group_name_cache),
+        ("search", helper.search_cache),
+    ):
+        for stat, value in cache.stats().items():
+            gauges.append((f"cache_{stat}", f"Cache {stat}", {"cache": cache_name}, value))
+    index_stats = helper.group_index.stats()
+    gauges.append(
+        ("autocomplete_groups", "Groups in the autocomplete index", {}, index_stats["groups"])
+    )
+    for stat, value in index_stats["cache"].items():
+        gauges.append((f"cache_{stat}", f"Cache {stat}", {"cache": "autocomplete"}, value))
+    if receipts.receipt_buffer:
+        buffer_stats = receipts.receipt_buffer.stats()
+        for stat in ("depth", "flushes", "writes", "errors"):
+            gauges.append(
+                (f"write_behind_{stat}", f"Write-behind buffer {stat}", {}, buffer_stats[stat])
+            )
+        # Gauges are summed across workers, so the latency of each worker is kept apart
+        gauges.append(
+            (
+                "write_behind_last_flush_seconds",
+                "Time taken by the last flush of the write-behind buffer",
+                {"pid": os.getpid()},
+                buffer_stats["last_flush_seconds"],
+            )
+        )
+    return gauges
+
+
+metrics.registry.register_collector(helper_metrics)
+
+
+@app.before_request
+def start_timer():
+    metrics.begin_request(request.url_rule.rule if request.url_rule else "unmatched")
+    if request_profiler.requested(request.headers.get("X-Profile"), request.args.get("profile")):
+        g.profile = request_profiler.start()
+
+
+@app.after_request
+def record_metrics(response: Response) -> Response:
+    """Records the latency and the number of MongoDB commands of a request, and saves its profile
+
+    This is registered before compress, so that it runs after it, and compression is timed too.
+
+    Args:
+        response: The response to the request
+
+    Returns:
+        The same response
+    """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "profile" in g:
+        response.headers["X-Profile-File"] = request_profiler.stop(g.pop("profile"), route)
+    metrics.record_request(request.method, response.status_code)
+    return response
+
+
+@app.after_request
+def compress(response: Response) -> Response:
+    """Compresses API responses with gzip, if the client accepts it
+
+    Args:
+        response: The response to compress
+
+    Returns:
+        The response, compressed if it is an API response of at least GZIP_MIN_SIZE bytes
+    """
+    if (
+        request.path.startswith("/api/")
+        and response.status_code == 200
+        and not response.direct_passthrough
+        and "Content-Encoding" not in response.headers
+        and "gzip" in request.accept_encodings
+    ):
+        response.vary.add("Accept-Encoding")
+        data = response.get_data()
+        if len(data) >= GZIP_MIN_SIZE:
+            response.set_data(gzip.compress(data, compresslevel=6))
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
 
 def check_authentication() -> bool:
     """Checks whether current session is authenticated
@@ -77,10 +186,21 @@ def logout():
 @app.route("/admin")
 def admin():
     page = int(request.args.get("page", 1))
-    if query := request.args.get("query"):  # Query
-        posts = helper.search_for_post(session["logged_in"], query, page)
-    else:  # All posts
-        posts = helper.get_posts(session["logged_in"], page, 0)
+    cursor = request.args.get("cursor")
+    rank = request.args.get("rank", "recent")
+    truncated = False
+    try:
+        if query := request.args.get("query"):  # Query
+            posts = helper.search_for_post(
+                session["logged_in"], query, page, cursor=cursor, rank=rank
+            )
+            _, truncated = helper.search_post_ids(session["logged_in"], query, rank)  # Cached
+        else:  # All posts
+            posts = helper.get_posts(session["logged_in"], page, 0, cursor)
+    except ValueError:
+        flash("Invalid page, returning to the first page.", "error")
+        return redirect(url_for("admin", query=query))
+    cursor = feed.next_cursor(posts)
 
     for post in posts:
         post["date_created"] = datetime.datetime.fromtimestamp(
@@ -92,9 +212,18 @@ def admin():
     if page != 1 and len(posts) == 0:
         flash("No more posts to load!", "info")
         page -= 1
-        return redirect(url_for("admin", page=page, query=query))
-
-    return render_template("admin.html", posts=posts, page=page, query=query)
+        return redirect(url_for("admin", page=page, query=query, rank=rank))
+
+    return render_template(
+        "admin.html",
+        posts=posts,
+        page=page,
+        query=query,
+        cursor=cursor,
+        rank=rank,
+        truncated=truncated,
+        search_limit=helper.SEARCH_LIMIT,
+    )
 
 
 @app.route("/posts/view")
@@ -108,18 +237,59 @@ def posts_view():
         post["date_due"] = datetime.datetime.fromtimestamp(post["date_due"]).strftime("%Y-%m-%d")
     else:
         post["date_due"] = ""
-    return render_template("posts_view.html", post=post, username=session["logged_in"])
+
+    roster_page = int(request.args.get("roster_page", 1))
+    roster_filter = request.args.get("roster_filter", "all")
+    try:
+        roster = helper.get_roster(post_id, roster_page, roster_filter)
+    except ValueError:
+        roster_filter = "all"
+        roster = helper.get_roster(post_id, roster_page, roster_filter)
+    return render_template(
+        "posts_view.html",
+        post=post,
+        username=session["logged_in"],
+        roster=roster,
+        roster_page=roster_page,
+        roster_filter=roster_filter,
+        roster_page_size=helper.ROSTER_PAGE_SIZE,
+    )
+
+
+@app.route("/posts/roster")
+def posts_roster():
+    post_id = request.args.get("id")
+    if post_id is None:
+        return make_response(dumps({"message": "Missing parameters"}), 400)
+    try:
+        roster = helper.get_roster(
+            post_id, int(request.args.get("page", 1)), request.args.get("filter", "all")
+        )
+    except ValueError as error:
+        return make_response(dumps({"message": str(error)}), 400)
+    return make_response(dumps({"data": roster}), 200)
 
 
 @app.route("/posts/download")
 def posts_download():
     post_id = request.args.get("id")
+    file_format = request.args.get("format", "csv")
 
     if post_id is None:
         return "Missing params"
 
+    rows = helper.download_post(post_id)
+    if rows is None:
+        return make_response("Post not found", 404)
+
+    if file_format == "xlsx":
+        return Response(
+            stream_with_context(export.to_xlsx(rows)),
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-disposition": f"attachment; filename={post_id}.xlsx"},
+        )
     return Response(
-        helper.download_post(post_id).to_csv(index=False),
+        stream_with_context(export.to_csv(rows)),
         mimetype="text/csv",
         headers={"Content-disposition": f"attachment; filename={post_id}.csv"},
     )
@@ -310,22 +480,48 @@ def api_users_setexpopushtoken():
     return make_response(dumps({"message": "An error occurred"}), 400)
 
 
+@app.route("/api/users/badge")
+def api_users_badge():
+    username = request.args.get("username")
+    if username is None:
+        return make_response(dumps({"message": "Missing parameters"}), 400)
+    return make_response(dumps(badges.get_badge(username)), 200)
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render_all(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/api/posts/home", methods=["GET"])
 def api_posts_home():
-    time_received = time()
+    try:
+        params = feed.feed_params(request.args)
+        etag = helper.feed_etag(*params)
+    except ValueError as error:
+        return str(error)
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        try:
+            data = helper.get_posts(*params)
+        except ValueError:
+            return make_response(dumps({"message": "Invalid cursor"}), 400)
+        response = make_response(dumps(feed.feed_page(data, params[-1])))
+    response.set_etag(etag, weak=True)
+    return response
+
+
+@app.route("/api/posts/sync", methods=["GET"])
+def api_posts_sync():
     username = request.args.get("username")
-    page = request.args.get("page")
-    todo = request.args.get("todo")
+    if username is None:
+        return make_response(dumps({"message": "Missing parameters"}), 400)
     try:
-        page = int(page)
-        todo = bool(int(todo))
-    except (ValueError, TypeError):
-        return "Why are you even trying?"
-    if username and page:
-        data = helper.get_posts(username, int(page), todo)
-        print(f"Time taken: {time() - time_received}")
-        return dumps({"data": data})
-    return "Please provide all of the arguments required."
+        changes = sync.get_changes(username, request.args.get("since"))
+    except ValueError as error:  # Invalid or expired, the client must sync again without a token
+        return make_response(dumps({"message": str(error)}), 400)
+    return make_response(dumps(changes), 200)
 
 
 @app.route("/api/posts/view")
@@ -334,7 +530,7 @@ def api_posts_view():
     post_id = request.args.get("id")
     if username is None or post_id is None:
         return make_response(dumps({"message": "Missing parameters"}), 400)
-    if helper.view_post(username, post_id):
+    if receipts.view_post(username, post_id):
         return make_response(dumps({"message": "Success"}), 200)
     return make_response(dumps({"message": "An error occurred"}), 400)
 
@@ -347,11 +543,27 @@ def api_posts_respond():
     if username is None or post_id is None or response is None:
         return make_response(dumps({"message": "Missing parameters"}), 400)
     response = True if response == "true" else False  # pylint: disable=R1719
-    if helper.respond_post(username, post_id, response):
+    if receipts.respond_post(username, post_id, response):
         return make_response(dumps({"message": "Success"}), 200)
     return make_response(dumps({"message": "An error occurred"}), 400)
 
 
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return make_response(dumps({"message": "Missing parameters"}), 400)
+    username = body.get("username")
+    operations = body.get("operations")
+    if not isinstance(username, str) or not username or not isinstance(operations, list):
+        return make_response(dumps({"message": "Missing parameters"}), 400)
+    try:
+        results = receipts.apply_receipts(username, operations)
+    except ValueError as error:
+        return make_response(dumps({"message": str(error)}), 400)
+    return make_response(dumps({"message": "Success", "data": results}), 200)
+
+
 @app.route("/api/autocomplete", methods=["GET"])
 def autocomplete():
     query_string = request.args.get("term")
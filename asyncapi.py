@@ -0,0 +1,369 @@
+"""Asynchronous mobile API
+
+This module serves the /api/* routes that the mobile app polls on asyncio, with the motor driver,
+so that a worker is not held for the whole of every MongoDB round trip, and one worker can serve
+many students at once. It is a separate ASGI app, which can be run next to app.py:
+
+    hypercorn asyncapi:app --bind 0.0.0.0:8001
+
+with these paths routed to it, which are the only ones it serves:
+
+    /api/users/badge, /api/posts/home, /api/posts/stream, /api/posts/view, /api/posts/respond,
+    /api/autocomplete
+
+The other /api/ paths (/api/auth/, /api/posts/sync, /api/batch and /api/users/setExpoPushToken)
+stay on app.py. The responses are the same as those of app.py. Queries and
+writes are built by helper.py and run with motor: the feeds use the same aggregation stages, and
+views and responses the same upserts and follow-up writes (see receipts.receipt_writes).
+Autocomplete, and views and responses when write-behind buffering is enabled, which only touch
+in-memory data, run the functions of helper.py in a thread pool of ASYNC_API_THREADS threads.
+
+Caches are per process, so the membership cache of this app is only refreshed by its time to
+live (MEMBERSHIP_CACHE_TTL) after groups are changed through app.py.
+
+/api/posts/stream is a server-sent events stream of the changes of a user's posts (see
+broker.py), so that clients do not have to poll /api/posts/home. Idle streams only hold a queue
+on the event loop, so one worker can keep thousands of them open.
+"""
+# pylint: disable=missing-function-docstring
+import asyncio
+import gzip
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+from bson.json_util import dumps
+from quart import Quart, Response, make_response, request
+
+import badges
+import feed
+import helper
+import inbox
+import metrics
+import receipts
+import sync
+import versions
+from broker import watch_changes
+from database import DATABASE_NAME, AsyncDatabase
+
+GZIP_MIN_SIZE = 500  # Smallest API response, in bytes, that is compressed
+
+app = Quart(__name__)
+db = AsyncDatabase(DATABASE_NAME)
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASYNC_API_THREADS", "16")), thread_name_prefix="asyncapi"
+)
+background_tasks = set()
+
+
+async def run_sync(function, *args):
+    """Runs a synchronous function in the thread pool
+
+    Args:
+        function: The function to run
+        args: The arguments of the function
+
+    Returns:
+        The return value of the function
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def group_ids_with_user(username: str) -> list:
+    """Finds the ids of the group(s) with user in it/them, like feed.group_ids_with_user
+
+    Args:
+        username: A string representing the username of the user
+
+    Returns:
+        A list containing ObjectIds that represent the ids of the groups that user is in
+    """
+    group_ids = feed.membership_cache.get(username)
+    if group_ids is None:
+        cursor = db["groups"].find(feed.membership_filter(username), {"_id": 1})
+        group_ids = frozenset([group["_id"] async for group in cursor])
+        feed.membership_cache.set(username, group_ids)
+    return list(group_ids)
+
+
+async def fetch_user_names(usernames: list) -> dict:
+    return {
+        user["username"]: user["name"]
+        async for user in db["users"].find(
+            {"username": {"$in": usernames}}, {"username": 1, "name": 1}
+        )
+    }
+
+
+async def fetch_group_names(group_ids: list) -> dict:
+    return {
+        group["_id"]: group["name"]
+        async for group in db["groups"].find({"_id": {"$in": group_ids}}, {"name": 1})
+    }
+
+
+async def format_posts(posts: list) -> list:
+    """Formats posts for a user's feed, like feed.format_posts
+
+    Args:
+        posts: A list containing dictionary objects that represent a post, with "viewed" and
+            "acknowledged" already set
+
+    Returns:
+        A list containing the posts, with author and group names attached
+    """
+    authors = await feed.user_name_cache.get_many_async(
+        [post["author_id"] for post in posts], fetch_user_names
+    )
+    groups = await feed.group_name_cache.get_many_async(
+        [post["group_id"] for post in posts], fetch_group_names
+    )
+    return feed.name_posts(posts, authors, groups)
+
+
+async def get_posts(
+    username: str, page: int, todo: int, cursor: str = None, page_size: int = feed.PAGE_SIZE
+) -> list:
+    """Gets the posts of a user, by page, like helper.get_posts
+
+    Args:
+        See helper.get_posts
+
+    Returns:
+        A list containing dictionary objects that represent a post
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    if inbox.INBOX:
+        collection = "inbox"
+        stages = inbox.inbox_stages(username, page, todo, cursor, page_size)
+    else:
+        collection = "posts"
+        group_ids = await group_ids_with_user(username)
+        stages = feed.feed_stages(
+            username, group_ids, page, todo, cursor=cursor, page_size=page_size
+        )
+    user_posts = await db.feed_collection(collection).aggregate(stages).to_list(None)
+    if receipts.receipt_buffer:
+        receipts.receipt_buffer.overlay(username, user_posts)
+    return await format_posts(user_posts)
+
+
+async def feed_etag(username: str, *params) -> str:
+    """Computes an entity tag for a user's feed, like helper.feed_etag and versions.read_versions
+
+    Args:
+        username: A string representing the username of the user
+        params: The parameters of the request, such as the page and the todo filter
+
+    Returns:
+        A string representing the entity tag
+    """
+    keys = versions.version_keys(username, await group_ids_with_user(username))
+    stamps = {
+        doc["_id"]: doc["version"]
+        async for doc in db.feed_collection("versions").find({"_id": {"$in": keys}})
+    }
+    return versions.hash_versions(keys, stamps, params + receipts.buffered_receipts(username))
+
+
+async def write_all(writes: dict):
+    """Runs writes built by receipts.receipt_writes, like receipts.write_all
+
+    Args:
+        writes: A dictionary in the form of {collection: requests}
+    """
+    for collection, requests in writes.items():
+        await db[collection].bulk_write(requests, ordered=False)
+
+
+async def view_post(username: str, post_id: str) -> bool:
+    """Sets the status of a post to read, like receipts.view_post
+
+    Args:
+        See receipts.view_post
+
+    Returns:
+        A boolean value indicating if setting the post to viewed was successful
+    """
+    if receipts.receipt_buffer:
+        return await run_sync(receipts.view_post, username, post_id)
+    post = await db["posts"].find_one({"_id": ObjectId(post_id)}, {"requires_acknowledgement": 1})
+    if post is None:
+        return False
+    update = await db["receipts"].update_one(**receipts.view_upsert(username, post))
+    if update.upserted_id is None:
+        return False
+    await write_all(receipts.view_writes(username, post))
+    return True
+
+
+async def respond_post(username: str, post_id: str, response: bool) -> bool:
+    """Indicate the response by a user to a post, like receipts.respond_post
+
+    Args:
+        See receipts.respond_post
+
+    Returns:
+        A boolean value indicating if the submitting of the response was successful
+    """
+    if receipts.receipt_buffer:
+        return await run_sync(receipts.respond_post, username, post_id, response)
+    if await db["posts"].find_one({"_id": ObjectId(post_id)}, {"_id": 1}) is None:
+        return False
+    before = await db["receipts"].find_one_and_update(
+        **receipts.response_upsert(username, post_id, response)
+    )
+    changed, writes = receipts.response_writes(username, post_id, response, before)
+    await write_all(writes)
+    return changed
+
+
+@app.before_serving
+async def start_streams():
+    """Attaches the event broker to the event loop, and starts reading the changes of posts"""
+    sync.post_events.attach(asyncio.get_running_loop())
+    background_tasks.add(
+        asyncio.create_task(watch_changes(sync.post_events, db.client[db.name]))
+    )
+
+
+@app.after_serving
+async def stop_streams():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+
+
+@app.before_request
+async def start_timer():
+    metrics.begin_request(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+async def record_metrics(response: Response) -> Response:
+    """Records the latency and the number of MongoDB commands of a request, like app.py
+
+    This is registered before compress, so that it runs after it, and compression is timed too.
+    Streams are recorded when they start.
+
+    Args:
+        response: The response to the request
+
+    Returns:
+        The same response
+    """
+    metrics.record_request(request.method, response.status_code)
+    return response
+
+
+@app.after_request
+async def compress(response: Response) -> Response:
+    """Compresses API responses with gzip, if the client accepts it, like app.compress
+
+    Args:
+        response: The response to compress
+
+    Returns:
+        The response, compressed if it is at least GZIP_MIN_SIZE bytes
+    """
+    if (
+        response.status_code == 200
+        and response.mimetype != "text/event-stream"
+        and "Content-Encoding" not in response.headers
+        and "gzip" in request.accept_encodings
+    ):
+        response.vary.add("Accept-Encoding")
+        data = await response.get_data()
+        if len(data) >= GZIP_MIN_SIZE:
+            response.set_data(gzip.compress(data, compresslevel=6))
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+@app.route("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render_all(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/users/badge")
+async def api_users_badge():
+    username = request.args.get("username")
+    if username is None:
+        return await make_response(dumps({"message": "Missing parameters"}), 400)
+    badge = await db["badges"].find_one({"_id": username})
+    return await make_response(dumps(badges.format_badge(badge)), 200)
+
+
+@app.route("/api/posts/home", methods=["GET"])
+async def api_posts_home():
+    try:
+        params = feed.feed_params(request.args)
+        etag = await feed_etag(*params)
+    except ValueError as error:
+        return str(error)
+    if request.if_none_match.contains_weak(etag):
+        response = await make_response("", 304)
+    else:
+        try:
+            data = await get_posts(*params)
+        except ValueError:
+            return await make_response(dumps({"message": "Invalid cursor"}), 400)
+        response = await make_response(dumps(feed.feed_page(data, params[-1])))
+    response.set_etag(etag, weak=True)
+    return response
+
+
+@app.route("/api/posts/stream")
+async def api_posts_stream():
+    username = request.args.get("username")
+    if username is None:
+        return await make_response(dumps({"message": "Missing parameters"}), 400)
+    subscription = sync.post_events.subscribe(
+        username,
+        await group_ids_with_user(username),
+        request.headers.get("Last-Event-ID") or request.args.get("last_event_id"),
+    )
+    response = await make_response(
+        sync.post_events.messages(subscription, lambda: group_ids_with_user(username)),
+        200,
+        {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"},
+    )
+    response.timeout = None  # Streams stay open until the client disconnects
+    return response
+
+
+@app.route("/api/posts/view")
+async def api_posts_view():
+    username = request.args.get("username")
+    post_id = request.args.get("id")
+    if username is None or post_id is None:
+        return await make_response(dumps({"message": "Missing parameters"}), 400)
+    if await view_post(username, post_id):
+        return await make_response(dumps({"message": "Success"}), 200)
+    return await make_response(dumps({"message": "An error occurred"}), 400)
+
+
+@app.route("/api/posts/respond")
+async def api_posts_respond():
+    username = request.args.get("username")
+    post_id = request.args.get("id")
+    response = request.args.get("response")
+    if username is None or post_id is None or response is None:
+        return await make_response(dumps({"message": "Missing parameters"}), 400)
+    response = True if response == "true" else False  # pylint: disable=R1719
+    if await respond_post(username, post_id, response):
+        return await make_response(dumps({"message": "Success"}), 200)
+    return await make_response(dumps({"message": "An error occurred"}), 400)
+
+
+@app.route("/api/autocomplete", methods=["GET"])
+async def autocomplete():
+    query_string = request.args.get("term")
+    username = request.args.get("username")
+    if query_string and username:
+        return dumps(
+            await run_sync(lambda: helper.search_for_group(username, query_string, True))
+        )
+    return "No query string/username provided"
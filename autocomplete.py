@@ -0,0 +1,201 @@
+"""Group autocomplete for helper.py
+
+This module keeps an in-memory index of group names for each owner, so that autocomplete
+suggestions are answered without querying the database on every keystroke. Each word of a
+group's name is indexed for prefix matching ("bio" finds "Biology"), and each trigram of the
+whole name for substring matching ("olog" finds "Biology"), which is used when no prefix
+matches.
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+from time import monotonic
+
+from cache import LRUCache
+
+
+def tokenize(text: str) -> list:
+    """Splits text into lowercase words
+
+    Args:
+        text: A string representing the text
+
+    Returns:
+        A list containing strings that represent the words
+    """
+    return re.findall(r"\w+", text.lower())
+
+
+def trigrams(text: str) -> set:
+    """Gets the trigrams (substrings of length 3) of text
+
+    Args:
+        text: A string representing the text, which should already be lowercase
+
+    Returns:
+        A set containing strings that represent the trigrams
+    """
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class GroupIndex:  # pylint: disable=too-many-instance-attributes
+    """A per-owner prefix and trigram index of group names
+
+    The index is loaded on first use, and loaded again after ttl seconds, so that changes made
+    by other processes are picked up. Changes made in this process should be applied with add and
+    remove, which take effect immediately.
+
+    Attributes:
+        load: A function that returns an iterable of dictionaries that represent every group,
+            with "_id", "name" and "owners"
+        ttl: A float representing the number of seconds before the index is loaded again
+        limit: An integer representing the default largest number of suggestions returned
+    """
+
+    def __init__(self, load, ttl: float = 300.0, limit: int = 10, cache_size: int = 10000):
+        self.load = load
+        self.ttl = ttl
+        self.limit = limit
+        self._groups = {}  # {group_id: (name, owners)}
+        self._words = {}  # {owner: sorted list of (word, group_id)}
+        self._trigrams = {}  # {owner: {trigram: set of group_ids}}
+        self._loaded = None
+        self._lock = threading.RLock()
+        self._cache = LRUCache(cache_size, ttl)  # {(username, query): suggestions}
+
+    def search(self, username: str, query: str, limit: int = None) -> list:
+        """Suggests groups owned by a user that match a query
+
+        Every word of the query must be a prefix of a word of the group's name. If no group
+        matches that way, groups whose name contains the query are suggested instead. Groups
+        whose name starts with the query come first, then groups with more words matching
+        exactly, then shorter names.
+
+        Args:
+            username: A string representing the username of the owner
+            query: A string representing the query string
+            limit: An integer representing the largest number of suggestions returned, or 0 for
+                no limit. Defaults to the limit of the index
+
+        Returns:
+            A list containing tuples in the form of (group_id, name)
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        key = (username, " ".join(words))
+        limit = self.limit if limit is None else limit
+        suggestions = self._cache.get(key)
+        if suggestions is not None:
+            return suggestions[:limit] if limit else suggestions
+
+        with self._lock:
+            self._ensure_loaded()
+            candidates = self._prefix_matches(username, words)
+
+            text = " ".join(words)
+            if not candidates and len(text) >= 3:
+                trigram_index = self._trigrams.get(username, {})
+                candidates = set.intersection(
+                    *[trigram_index.get(trigram, set()) for trigram in trigrams(text)]
+                )
+                candidates = {
+                    group_id
+                    for group_id in candidates
+                    if text in " ".join(tokenize(self._groups[group_id][0]))
+                }
+
+            names = [(group_id, self._groups[group_id][0]) for group_id in candidates]
+
+        def rank(suggestion):
+            name = suggestion[1].lower()
+            return (
+                not name.startswith(text),
+                -len(set(words) & set(tokenize(name))),
+                len(name),
+                name,
+            )
+
+        suggestions = sorted(names, key=rank)
+        self._cache.set(key, suggestions)
+        return suggestions[:limit] if limit else suggestions
+
+    def add(self, group: dict):
+        """Adds a group to the index, replacing it if it is already indexed
+
+        Args:
+            group: A dictionary object that represents the group, with "_id", "name" and "owners"
+        """
+        with self._lock:
+            self._remove(group["_id"])
+            self._add(group)
+            self._cache.clear()
+
+    def remove(self, group_id):
+        """Removes a group from the index
+
+        Args:
+            group_id: An ObjectId representing the id of the group
+        """
+        with self._lock:
+            self._remove(group_id)
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        """Gets statistics of the index
+
+        Returns:
+            A dictionary containing "groups" (the number of groups indexed) and "cache" (the
+            statistics of the suggestion cache)
+        """
+        with self._lock:
+            return {"groups": len(self._groups), "cache": self._cache.stats()}
+
+    def _ensure_loaded(self):
+        if self._loaded is not None and monotonic() - self._loaded < self.ttl:
+            return
+        self._groups, self._words, self._trigrams = {}, {}, {}
+        for group in self.load():
+            self._add(group, sort=False)
+        for words_index in self._words.values():
+            words_index.sort()
+        self._loaded = monotonic()
+        self._cache.clear()
+
+    def _prefix_matches(self, username: str, words: list) -> set:
+        words_index = self._words.get(username, [])
+        candidates = None
+        for word in words:
+            matches = set()
+            i = bisect_left(words_index, (word,))
+            while i < len(words_index) and words_index[i][0].startswith(word):
+                matches.add(words_index[i][1])
+                i += 1
+            candidates = matches if candidates is None else candidates & matches
+        return candidates
+
+    def _add(self, group: dict, sort: bool = True):
+        name = group.get("name", "")
+        owners = list(group.get("owners", []))
+        self._groups[group["_id"]] = (name, owners)
+        name_trigrams = trigrams(" ".join(tokenize(name)))
+        for owner in owners:
+            words_index = self._words.setdefault(owner, [])
+            for word in set(tokenize(name)):
+                if sort:
+                    insort(words_index, (word, group["_id"]))
+                else:
+                    words_index.append((word, group["_id"]))
+            trigram_index = self._trigrams.setdefault(owner, {})
+            for trigram in name_trigrams:
+                trigram_index.setdefault(trigram, set()).add(group["_id"])
+
+    def _remove(self, group_id):
+        if group_id not in self._groups:
+            return
+        name, owners = self._groups.pop(group_id)
+        name_trigrams = trigrams(" ".join(tokenize(name)))
+        for owner in owners:
+            self._words[owner] = [entry for entry in self._words[owner] if entry[1] != group_id]
+            for trigram in name_trigrams:
+                self._trigrams[owner][trigram].discard(group_id)
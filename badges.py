@@ -0,0 +1,224 @@
+# pylint: disable=consider-using-dict-comprehension
+"""Per-user to-do counters
+
+If the BADGES environment variable is set, the numbers of posts that each user has not viewed, or
+has not responded to, are kept up to date by the writes of helper.py and receipts.py, so that
+get_badge costs one read. reconcile_badges recounts them.
+"""
+import os
+
+import pymongo
+
+import feed
+from database import db
+
+BADGES = bool(os.getenv("BADGES"))  # Maintain per-user to-do counters (see get_badge)
+
+
+def increment_badges(deltas: dict):
+    """Atomically changes the to-do counters of users
+
+    Args:
+        deltas: A dictionary in the form of {username: {"unviewed": int, "pending": int}}, where
+            either count may be left out
+    """
+    requests = badge_requests(deltas)
+    for i in range(0, len(requests), 1000):
+        db["badges"].bulk_write(requests[i : i + 1000], ordered=False)
+
+
+def badge_requests(deltas: dict) -> list:
+    """Builds the writes that change the to-do counters of users
+
+    Args:
+        deltas: See increment_badges
+
+    Returns:
+        A list containing pymongo.UpdateOne objects, for a bulk_write on the badges collection
+    """
+    return [
+        pymongo.UpdateOne({"_id": username}, {"$inc": delta}, upsert=True)
+        for username, delta in deltas.items()
+        if any(delta.values())
+    ]
+
+
+def post_badge_deltas(post: dict, usernames: list, sign: int, deltas: dict = None) -> dict:
+    """Counts a post in, or out of, the to-do counters of users
+
+    Args:
+        post: A dictionary object that represents the post, with "_id" and
+            "requires_acknowledgement"
+        usernames: A list containing strings that represent the usernames of the users
+        sign: An integer that is 1 to count the post in, or -1 to count it out
+        deltas: A dictionary of deltas to add to, see increment_badges. Defaults to None
+
+    Returns:
+        A dictionary in the form of {username: {"unviewed": int, "pending": int}}, for
+        increment_badges. If deltas is given, it is returned, with the post's deltas added
+    """
+    deltas = {} if deltas is None else deltas
+    receipts = dict(
+        [
+            (receipt["username"], receipt["response"])
+            for receipt in db["receipts"].find(
+                {"post_id": post["_id"], "username": {"$in": usernames}},
+                {"_id": 0, "username": 1, "response": 1},
+            )
+        ]
+    )
+    for username in usernames:
+        delta = deltas.setdefault(username, {"unviewed": 0, "pending": 0})
+        if username not in receipts:
+            delta["unviewed"] += sign
+        elif post["requires_acknowledgement"] and receipts[username] is None:
+            delta["pending"] += sign
+    return deltas
+
+
+def update_pending(post_id, requires_acknowledgement: bool):
+    """Sets the "pending" flag of every receipt of a post, after requires_acknowledgement changed
+
+    Args:
+        post_id: An ObjectId representing the id of the post
+        requires_acknowledgement: A boolean value indicating if the post requires acknowledgement
+    """
+    db["receipts"].update_many(
+        {"post_id": post_id},
+        [
+            {
+                "$set": {
+                    "pending": {
+                        "$and": [
+                            requires_acknowledgement,
+                            {"$eq": [{"$ifNull": ["$response", None]}, None]},
+                        ]
+                    }
+                }
+            }
+        ],
+    )
+
+
+def group_users(group_ids) -> list:
+    """Gets the owners and members of groups
+
+    Args:
+        group_ids: An iterable of ObjectIds representing the ids of the groups
+
+    Returns:
+        A list containing strings that represent the usernames of the users, without duplicates
+    """
+    usernames = set()
+    for group in db["groups"].find({"_id": {"$in": list(group_ids)}}, {"owners": 1, "members": 1}):
+        usernames.update(group.get("owners", []) + group.get("members", []))
+    return list(usernames)
+
+
+def reconcile_badges(usernames: list = None) -> int:
+    """Recounts the to-do counters of users from their posts and receipts
+
+    This fixes any drift of the counters kept by helper.create_post, helper.update_post,
+    helper.delete_post, receipts.view_post and receipts.respond_post, and is run for every user by
+    'python migrations.py --badges'. The "pending" flag of the users' receipts, which
+    receipts.respond_post relies on, is rewritten too (it is missing from receipts written before
+    BADGES was enabled).
+
+    Args:
+        usernames: A list containing strings that represent the usernames of the users.
+            Defaults to None, which is every user
+
+    Returns:
+        An integer representing the number of users recounted
+    """
+    if usernames is None:
+        usernames = [user["username"] for user in db["users"].find({}, {"username": 1})]
+    for username in usernames:
+        groups = [
+            group["_id"]
+            for group in db["groups"].find(feed.membership_filter(username), {"_id": 1})
+        ]
+        acknowledged_posts = [
+            post["_id"]
+            for post in db["posts"].find(
+                {"group_id": {"$in": groups}, "requires_acknowledgement": True}, {"_id": 1}
+            )
+        ]
+        pending = {"post_id": {"$in": acknowledged_posts}, "response": None}
+        db["receipts"].update_many(
+            dict(pending, username=username, pending={"$ne": True}), {"$set": {"pending": True}}
+        )
+        db["receipts"].update_many(
+            {"username": username, "pending": {"$ne": False}, "$nor": [pending]},
+            {"$set": {"pending": False}},
+        )
+        counts = next(
+            db["posts"].aggregate(
+                [
+                    {"$match": {"group_id": {"$in": groups}}},
+                    {"$project": {"requires_acknowledgement": 1}},
+                ]
+                + feed.receipt_stages(username)
+                + [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "unviewed": {"$sum": {"$cond": ["$viewed", 0, 1]}},
+                            "pending": {
+                                "$sum": {
+                                    "$cond": [
+                                        {
+                                            "$and": [
+                                                "$viewed",
+                                                "$requires_acknowledgement",
+                                                {"$eq": ["$acknowledged", None]},
+                                            ]
+                                        },
+                                        1,
+                                        0,
+                                    ]
+                                }
+                            },
+                        }
+                    }
+                ]
+            ),
+            {"unviewed": 0, "pending": 0},
+        )
+        db["badges"].replace_one(
+            {"_id": username},
+            {"unviewed": counts["unviewed"], "pending": counts["pending"]},
+            upsert=True,
+        )
+    return len(usernames)
+
+
+def get_badge(username: str) -> dict:
+    """Gets the to-do counters of a user
+
+    The counters are only kept when BADGES is enabled.
+
+    Args:
+        username: A string representing the username of the user
+
+    Returns:
+        A dictionary in the form of {"unviewed": int, "pending": int, "todo": int}, where todo
+        is the number of posts the user has to view or respond to
+    """
+    return format_badge(db["badges"].find_one({"_id": username}))
+
+
+def format_badge(badge: dict) -> dict:
+    """Formats the to-do counters of a user, as stored in the badges collection
+
+    Args:
+        badge: A dictionary object that represents the counters, or None if there are none
+
+    Returns:
+        A dictionary in the form of {"unviewed": int, "pending": int, "todo": int}, see get_badge.
+        Counters that drifted below zero are reported as zero
+    """
+    badge = badge or {}
+    unviewed = max(badge.get("unviewed", 0), 0)
+    pending = max(badge.get("pending", 0), 0)
+    return {"unviewed": unviewed, "pending": pending, "todo": unviewed + pending}
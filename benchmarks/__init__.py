@@ -0,0 +1,21 @@
+"""Benchmarks for helper.py and the HTTP API
+
+This package seeds a local MongoDB server with a synthetic school, measures the helper functions
+and the HTTP API against it, compares the results across commits, and checks the properties that
+must hold whatever the timings (see checks.py):
+
+    python -m benchmarks seed --users 10000 --groups 500 --posts 20000
+    python -m benchmarks micro --output before.json
+    python -m benchmarks check
+    python -m benchmarks load --clients 50 --duration 30 --output load.json
+    python -m benchmarks compare before.json after.json --threshold 0.2
+
+The benchmarks use the MONGO_URI and MONGO_DATABASE environment variables, which default to
+"mongodb://localhost:27017" and "students-gateway-benchmark". Seeding drops that database first,
+so it refuses to run against the production database.
+"""
+import os
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DATABASE", "students-gateway-benchmark")
+os.environ.setdefault("SECRET_KEY", "benchmark")
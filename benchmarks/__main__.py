@@ -0,0 +1,117 @@
+"""Command line interface of the benchmarks (see __init__.py)"""
+import argparse
+import json
+import subprocess
+import sys
+from time import time
+
+from bson.json_util import dumps
+
+
+def commit() -> str:
+    """Gets the current git commit
+
+    Returns:
+        A string representing the hash of the commit, or an empty string outside of a git tree
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def save(results: dict, output: str, parameters: dict):
+    """Prints results, and saves them as JSON if an output file is given
+
+    Args:
+        results: A dictionary in the form of {name: measurements}
+        output: A string representing the path of the output file, or None
+        parameters: A dictionary representing the parameters of the run
+    """
+    for name, measurements in results.items():
+        print(f"{name}: " + ", ".join(f"{key}={value:.3f}" for key, value in measurements.items()))
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(
+                dumps(
+                    {
+                        "commit": commit(),
+                        "time": int(time()),
+                        "parameters": parameters,
+                        "results": results,
+                    },
+                    indent=2,
+                )
+            )
+
+
+def main():  # pylint: disable=too-many-locals
+    """Runs the command given on the command line"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed_parser = commands.add_parser("seed", help="fill the benchmark database")
+    seed_parser.add_argument("--users", type=int, default=10000)
+    seed_parser.add_argument("--groups", type=int, default=500)
+    seed_parser.add_argument("--posts", type=int, default=20000)
+    seed_parser.add_argument("--seed", type=int, default=0)
+    micro_parser = commands.add_parser("micro", help="benchmark the helper functions")
+    micro_parser.add_argument("--repeat", type=int, default=50)
+    micro_parser.add_argument("--output")
+    commands.add_parser("check", help="check the helper functions for known bugs")
+    load_parser = commands.add_parser("load", help="load test the HTTP API")
+    load_parser.add_argument("--url", help="URL of a running server, instead of starting one")
+    load_parser.add_argument("--clients", type=int, default=50)
+    load_parser.add_argument("--duration", type=float, default=30.0)
+    load_parser.add_argument("--output")
+    compare_parser = commands.add_parser("compare", help="find regressions between two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    arguments = parser.parse_args()
+    parameters = {key: value for key, value in vars(arguments).items() if key != "output"}
+
+    # pylint: disable=import-outside-toplevel
+    if arguments.command == "compare":
+        from benchmarks.compare import compare
+
+        with open(arguments.baseline, encoding="utf-8") as baseline, open(
+            arguments.current, encoding="utf-8"
+        ) as current:
+            regressions = compare(json.load(baseline), json.load(current), arguments.threshold)
+        for regression in regressions:
+            print(regression)
+        sys.exit(1 if regressions else 0)
+
+    import helper
+
+    if arguments.command == "seed":
+        from benchmarks.seed import seed
+
+        counts = seed(helper.db, arguments.users, arguments.groups, arguments.posts, arguments.seed)
+        print(f"Seeded {helper.db.name}: {counts['counts']}")
+        return
+    fixtures = helper.db["benchmark"].find_one({"_id": "fixtures"})
+    if fixtures is None:
+        sys.exit("The database has not been seeded, run 'python -m benchmarks seed' first")
+    if arguments.command == "micro":
+        from benchmarks import micro
+
+        save(micro.run(fixtures, arguments.repeat), arguments.output, parameters)
+    elif arguments.command == "check":
+        from benchmarks import checks
+
+        failures = checks.run(fixtures)
+        for failure in failures:
+            print(failure)
+        sys.exit(1 if failures else 0)
+    else:
+        from benchmarks import load
+
+        results = load.run(fixtures, arguments.url, arguments.clients, arguments.duration)
+        save(results, arguments.output, parameters)
+
+
+if __name__ == "__main__":
+    main()
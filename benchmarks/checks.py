@@ -0,0 +1,566 @@
+"""Correctness checks against the seeded database
+
+Unlike the micro-benchmarks, every check here either passes or fails. Each one returns a list of
+strings that describe its failures, which is empty when it passes. Checks that write run last,
+since they change the data.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from secrets import token_hex
+from types import SimpleNamespace
+
+from bson.json_util import loads
+
+import broker
+import feed
+import helper
+import inbox
+import indexes
+import metrics
+import notifications
+import receipts
+import request_profiler
+import sync
+from benchmarks.micro import race_receipts
+from database import DATABASE_NAME, AsyncDatabase
+
+# Share of the time of a request that metrics and disabled profiling may take
+OVERHEAD_LIMIT = 0.02
+
+
+def commands_of(function) -> int:
+    """Counts the MongoDB commands run by a function, with the caches of helper.py empty
+
+    Args:
+        function: A function that takes no arguments
+
+    Returns:
+        An integer representing the number of commands
+    """
+    for cache in (feed.membership_cache, feed.user_name_cache, feed.group_name_cache):
+        cache.clear()
+    helper.search_cache.clear()
+    metrics.begin_request("check")
+    function()
+    return metrics.end_request()
+
+
+def check_command_counts(fixtures: dict) -> list:
+    """Checks that the feeds run the same number of commands whatever the number of posts
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    student, teacher, query = fixtures["student"], fixtures["teacher"], fixtures["query"]
+    failures = []
+    for name, function in (
+        ("get_posts", lambda size: helper.get_posts(student, 1, False, None, size)),
+        ("get_posts todo", lambda size: helper.get_posts(student, 1, True, None, size)),
+        ("search_for_post", lambda size: helper.search_for_post(teacher, query, 1, page_size=size)),
+    ):
+        counts = {
+            size: commands_of(lambda size=size, function=function: function(size))
+            for size in (1, 5, feed.MAX_PAGE_SIZE)
+        }
+        if len(set(counts.values())) > 1:
+            failures.append(f"{name}: commands per page size {counts}")
+    return failures
+
+
+def check_instrumentation_overhead(fixtures: dict, repeat: int = 100) -> list:
+    """Checks that metrics and disabled profiling take a negligible share of a request
+
+    The checks for a profile token and the CommandListener calls of every command of a home feed
+    request are timed with synthetic command events, and compared with the time of the request.
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        repeat: An integer representing the number of timed requests. Defaults to 100
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    home = partial(helper.get_posts, fixtures["student"], 1, False)
+    events = [
+        SimpleNamespace(
+            command_name="find",
+            command={"find": "posts", "filter": {}},
+            connection_id=("localhost", 27017),
+            request_id=request_id,
+            duration_micros=1000,
+        )
+        for request_id in range(commands_of(home))
+    ]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        home()
+    request = (time.perf_counter() - start) / repeat
+
+    listener = metrics.CommandListener()
+    token, request_profiler.PROFILE_TOKEN = request_profiler.PROFILE_TOKEN, None
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            metrics.begin_request("check")
+            request_profiler.requested(None, None)
+            for event in events:
+                listener.started(event)
+                listener.succeeded(event)
+            metrics.end_request()
+        overhead = (time.perf_counter() - start) / repeat
+    finally:
+        request_profiler.PROFILE_TOKEN = token
+    if overhead > request * OVERHEAD_LIMIT:
+        return [
+            f"instrumentation: {overhead * 1e3:.3f} ms for {len(events)} commands, "
+            f"over {OVERHEAD_LIMIT:.0%} of a {request * 1e3:.1f} ms request"
+        ]
+    return []
+
+
+def check_fan_out_commands() -> list:
+    """Checks that adding a user to a group runs the same number of commands whatever its posts
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    sizes = list(
+        helper.db["posts"].aggregate(
+            [{"$group": {"_id": "$group_id", "posts": {"$sum": 1}}}, {"$sort": {"posts": 1}}]
+        )
+    )
+    username = "check-fan-out"
+    try:
+        counts = {
+            size["posts"]: commands_of(partial(inbox.fan_out_group, size["_id"], [username]))
+            for size in (sizes[0], sizes[-1])
+        }
+    finally:
+        helper.db["inbox"].delete_many({"username": username})
+    if len(set(counts.values())) > 1:
+        return [f"fan_out_group: commands per number of posts {counts}"]
+    return []
+
+
+def check_query_plans() -> list:
+    """Checks that the hot queries of helper.py use indexes, see indexes.verify_query_plans
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    return [
+        f"query plan: {description} uses {', '.join(stages)}"
+        for description, stages in indexes.verify_query_plans(helper.db).items()
+    ]
+
+
+def check_lost_responses(fixtures: dict, users: int = 1000) -> list:
+    """Checks that concurrent first views and responses of the same users lose no response
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        users: An integer representing the number of users that view and respond at once.
+            Defaults to 1000
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    post_id = str(fixtures["unviewed_post"])
+    usernames = [f"check-race-{i}" for i in range(users)]
+    try:
+        responded = race_receipts(usernames, post_id)
+    finally:
+        helper.db["receipts"].delete_many({"username": {"$in": usernames}})
+        helper.db["badges"].delete_many({"_id": {"$in": usernames}})
+        helper.db["versions"].delete_many({"_id": {"$in": [f"user:{name}" for name in usernames]}})
+    if responded < users:
+        return [f"receipts: {users - responded} of {users} concurrent responses were lost"]
+    return []
+
+
+def check_fork_client() -> list:
+    """Checks that a forked process, such as a gunicorn worker, does not share the parent's client
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    parent = helper.db.client
+    parent.admin.command("ping")  # Open the parent's connections before forking
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # Child
+        status = 1
+        try:
+            os.close(read)
+            child = helper.db.client
+            child.admin.command("ping")
+            os.write(write, f"{os.getpid()} {child is parent}".encode())
+            status = 0
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+    os.close(write)
+    with os.fdopen(read) as pipe:
+        report = pipe.read().split()
+    os.waitpid(pid, 0)
+
+    if len(report) != 2:
+        return ["fork: the child could not use the database"]
+    failures = []
+    if report[1] != "False":
+        failures.append(f"fork: process {report[0]} reused the client of process {os.getpid()}")
+    if helper.db.client is not parent:
+        failures.append("fork: the parent's client was replaced")
+    return failures
+
+
+def write_post(username: str, group_id) -> str:
+    """Creates, updates and deletes a post through helper.py, as another process would
+
+    Args:
+        username: A string representing the username of an owner of the group
+        group_id: An ObjectId representing the id of the group
+
+    Returns:
+        A string representing the id of the post
+    """
+    title = f"Stream check {token_hex(4)}"
+    data = {"title": title, "body": "", "group_id": str(group_id), "location": None}
+    helper.create_post(username, dict(data, requires_acknowledgement=False, date_due=None))
+    post_id = str(helper.db["posts"].find_one({"title": title}, {"_id": 1})["_id"])
+    # Every write must be read before the next one: polls only see the last version of a post,
+    # and change streams skip the updates of posts deleted before they are read
+    time.sleep(broker.STREAM_POLL + 1)
+    helper.update_post(post_id, {"body": "Updated"})
+    time.sleep(broker.STREAM_POLL + 1)
+    helper.delete_post(post_id)
+    return post_id
+
+
+async def stream_events(watch, username: str, group_id, timeout: float = 10) -> tuple:
+    """Collects the events a user's stream is sent while write_post runs in another thread
+
+    The events of the process are never delivered, so that they can only come from the database.
+
+    Args:
+        watch: An async function that publishes the changes of the database to a broker, such as
+            broker.watch_changes
+        username, group_id: See write_post
+        timeout: A float representing the number of seconds to wait for the events. Defaults to
+            10
+
+    Returns:
+        A tuple containing:
+            - a string representing the id of the post
+            - a list containing tuples in the form of (event, post_id) of the events received
+    """
+    loop = asyncio.get_running_loop()
+    events = broker.Broker()
+    events.attach(loop)
+    subscription = events.subscribe(username, [group_id])
+    database = AsyncDatabase(DATABASE_NAME)
+    task = asyncio.create_task(watch(events, database.client[database.name]))
+    received = []
+    try:
+        for _ in range(int(timeout / 0.1)):  # Wait until the changes are read from the database
+            if not events.local:
+                break
+            await asyncio.sleep(0.1)
+        post_id = await loop.run_in_executor(None, write_post, username, group_id)
+        while len(received) < 3:
+            message = await asyncio.wait_for(subscription.queue.get(), timeout)
+            fields = dict([line.split(": ", 1) for line in message.strip().split("\n")])
+            data = loads(fields.get("data", "{}"))
+            received.append((fields.get("event"), str(data.get("post_id"))))
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        task.cancel()
+    return post_id, received
+
+
+def check_stream(fixtures: dict) -> list:
+    """Checks that the posts written by another process reach the streams of /api/posts/stream
+
+    This is checked both with watch_changes, which reads a change stream on a replica set and
+    polls on a standalone server, and with polling alone.
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    teacher = fixtures["teacher"]
+    group_id = helper.db["groups"].find_one({"owners": teacher}, {"_id": 1})["_id"]
+    failures = []
+    for name, watch in (
+        ("watch_changes", broker.watch_changes),
+        ("polling", lambda events, database: broker.poll_changes(events, database, 0.2)),
+    ):
+        post_id, received = asyncio.run(stream_events(watch, teacher, group_id))
+        expected = [(event, post_id) for event in ("post_created", "post_updated", "post_deleted")]
+        if received != expected:
+            failures.append(f"stream, {name}: sent {received} instead of {expected}")
+    return failures
+
+
+def check_broker() -> list:
+    """Checks that the broker replays missed events and evicts slow clients
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+
+    async def run_broker() -> list:
+        events = broker.Broker(queue_size=2)
+        events.attach(asyncio.get_running_loop())
+        group_id = helper.ObjectId()
+        first = events.subscribe("reader", [group_id])
+        events.publish("post_created", group_id, helper.ObjectId())
+        last_event_id = first.queue.get_nowait().split("\n")[0][len("id: ") :]
+        events.unsubscribe(first)
+        events.publish("post_deleted", group_id, helper.ObjectId())
+        failures = []
+        resumed = events.subscribe("reader", [group_id], last_event_id)
+        if resumed.queue.qsize() != 1 or "post_deleted" not in resumed.queue.get_nowait():
+            failures.append("broker: a resumed stream was not sent the missed event")
+        if events.subscribe("reader", [group_id], "unknown-1").queue.get_nowait() != broker.RESET:
+            failures.append("broker: an unknown Last-Event-ID was not sent a reset")
+        slow = events.subscribe("slow", [group_id])
+        for _ in range(3):
+            events.publish("post_updated", group_id, helper.ObjectId())
+        if not slow.evicted or slow.queue.get_nowait() != broker.EVICTED:
+            failures.append("broker: a client with a full queue was not evicted")
+        return failures
+
+    return asyncio.run(run_broker())
+
+
+def check_notifications(tokens: int = 250) -> list:
+    """Checks that notifications are sent to Expo in chunks, and that failed chunks are retried
+
+    Expo is replaced by a local stub server, which fails the first request with a 503.
+
+    Args:
+        tokens: An integer representing the number of push tokens to notify. Defaults to 250
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    payloads = []
+
+    class StubHandler(BaseHTTPRequestHandler):
+        """Answers like Expo's push API, except for the first request, which fails"""
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """Records the messages, and answers with a ticket for each of them"""
+            messages = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            payloads.append(messages)
+            if len(payloads) == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            tickets = [
+                {"status": "error", "details": {"error": "DeviceNotRegistered"}}
+                if message["to"] == "ExponentPushToken[dead]"
+                else {"status": "ok"}
+                for message in messages
+            ]
+            body = json.dumps({"data": tickets}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    push_url, backoff = notifications.PUSH_URL, notifications.BACKOFF
+    notifications.PUSH_URL = f"http://127.0.0.1:{server.server_port}/push/send"
+    notifications.BACKOFF = 0
+    push_tokens = [f"ExponentPushToken[{i}]" for i in range(tokens - 1)]
+    push_tokens.append("ExponentPushToken[dead]")
+    dead = []
+    try:
+        sent = notifications.notify(push_tokens, "Title", "Body", dead.extend)
+    finally:
+        notifications.PUSH_URL, notifications.BACKOFF = push_url, backoff
+        server.shutdown()
+        server.server_close()
+
+    failures = []
+    if not sent:
+        failures.append("notifications: notify failed against the stub server")
+    if len(payloads) < 2 or payloads[0] != payloads[1]:
+        failures.append("notifications: a chunk that failed with a 503 was not retried")
+    chunks = payloads[1:]
+    if [len(chunk) for chunk in chunks] != [
+        len(push_tokens[i : i + notifications.CHUNK_SIZE])
+        for i in range(0, len(push_tokens), notifications.CHUNK_SIZE)
+    ]:
+        failures.append(
+            f"notifications: {tokens} tokens were sent in chunks of "
+            f"{[len(chunk) for chunk in chunks]}"
+        )
+    if [message["to"] for chunk in chunks for message in chunk] != push_tokens or any(
+        message["title"] != "Title" or message["body"] != "Body"
+        for chunk in chunks
+        for message in chunk
+    ):
+        failures.append("notifications: the messages sent do not match the push tokens")
+    if dead != ["ExponentPushToken[dead]"]:
+        failures.append(f"notifications: the dead push tokens reported were {dead}")
+    return failures
+
+
+def sync_positions(username: str, since: str = None, limit: int = 1000) -> tuple:
+    """Follows the sync tokens of a user until there are no more changes
+
+    Args:
+        username: A string representing the username of the user
+        since: A string representing the sync token to start from, or None. Defaults to None
+        limit: An integer representing the largest number of calls to get_changes. Defaults to
+            1000
+
+    Returns:
+        A tuple containing:
+            - a list containing the (timestamp, post id) positions of the tokens returned with
+                more set, decoded, with "" for a missing post id
+            - a set containing the ids of the posts returned
+            - a string representing the last token, or None if limit calls were not enough
+    """
+    positions, post_ids = [], set()
+    for _ in range(limit):
+        changes = sync.get_changes(username, since)
+        post_ids.update(post["_id"] for post in changes["data"])
+        since = changes["since"]
+        if not changes["more"]:
+            return positions, post_ids, since
+        timestamp, post_id, _ = sync.decode_sync_token(since)
+        positions.append((timestamp, str(post_id or "")))
+    return positions, post_ids, None
+
+
+def check_sync_tokens(fixtures: dict) -> list:
+    """Checks that sync tokens always advance, even when only receipts changed
+
+    The student responds to every post of their groups, which changes none of the posts but all
+    of their receipts, and then syncs from the token they had before.
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    student = fixtures["student"]
+    _, _, since = sync_positions(student)
+    if since is None:
+        return ["sync: the first sync did not finish"]
+    post_ids = [
+        post["_id"]
+        for post in helper.db["posts"].find(
+            {"group_id": {"$in": feed.group_ids_with_user(student)}}, {"_id": 1}
+        )
+    ]
+    for i in range(0, len(post_ids), receipts.BATCH_LIMIT):
+        receipts.apply_receipts(
+            student,
+            [
+                {"op": "respond", "id": str(post_id), "response": False}
+                for post_id in post_ids[i : i + receipts.BATCH_LIMIT]
+            ],
+        )
+    if receipts.receipt_buffer:
+        receipts.receipt_buffer.flush()
+
+    timestamp, _, _ = sync.decode_sync_token(since)
+    positions, returned, last = sync_positions(student, since)
+    positions.insert(0, (timestamp, ""))
+    failures = []
+    if last is None:
+        failures.append("sync: the changes did not finish after 1000 calls")
+    if any(later <= earlier for earlier, later in zip(positions, positions[1:])):
+        failures.append(f"sync: a token did not advance, positions {positions}")
+    if missing := len(set(post_ids) - returned):
+        failures.append(f"sync: {missing} posts with changed receipts were not returned")
+    return failures
+
+
+def check_sync_membership(fixtures: dict) -> list:
+    """Checks that a sync returns the posts of joined groups, and of posts moved between groups
+
+    The student is added to a group with posts, and one of their posts is moved to another of
+    their groups, after which both are undone.
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+
+    Returns:
+        A list containing strings that describe the failures
+    """
+    student = fixtures["student"]
+    _, _, since = sync_positions(student)
+    groups = feed.group_ids_with_user(student)
+    joined = helper.db["groups"].find_one(
+        {"_id": {"$nin": groups}, "members": {"$exists": True}}, {"members": 1}
+    )
+    moved = helper.db["posts"].find_one({"group_id": groups[0]}, {"group_id": 1})
+    joined_posts = {
+        post["_id"] for post in helper.db["posts"].find({"group_id": joined["_id"]}, {"_id": 1})
+    }
+    helper.update_group(str(joined["_id"]), {"members": joined["members"] + [student]})
+    helper.update_post(str(moved["_id"]), {"group_id": groups[1]})
+    try:
+        changes = {"data": [], "tombstones": [], "more": True}
+        while changes["more"]:
+            page = sync.get_changes(student, since)
+            since = page["since"]
+            changes = dict(page, data=changes["data"] + page["data"])
+    finally:
+        helper.update_post(str(moved["_id"]), {"group_id": moved["group_id"]})
+        helper.update_group(str(joined["_id"]), {"members": joined["members"]})
+    returned = {post["_id"] for post in changes["data"]}
+    failures = []
+    if missing := len(joined_posts - returned):
+        failures.append(f"sync: {missing} posts of a joined group were not returned")
+    if moved["_id"] not in returned:
+        failures.append("sync: a post moved between the user's groups was not returned")
+    if {"post_id": moved["_id"]} in changes["tombstones"]:
+        failures.append("sync: a post moved between the user's groups has a tombstone")
+    return failures
+
+
+def run(fixtures: dict) -> list:
+    """Runs every check against the seeded database
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+
+    Returns:
+        A list containing strings that describe the failures of all checks
+    """
+    return (
+        check_command_counts(fixtures)
+        + check_query_plans()
+        + check_instrumentation_overhead(fixtures)
+        + check_fork_client()
+        + check_broker()
+        + check_notifications()
+        + check_fan_out_commands()
+        + check_lost_responses(fixtures)
+        + check_stream(fixtures)
+        + check_sync_tokens(fixtures)
+        + check_sync_membership(fixtures)
+    )
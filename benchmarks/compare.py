@@ -0,0 +1,42 @@
+"""Comparison of benchmark results across commits"""
+
+# Measurements where a higher value is worse
+LOWER_IS_BETTER = (
+    "p50_ms",
+    "p99_ms",
+    "ops_per_call",
+    "ops_per_request",
+    "bytes",
+    "lost_responses",
+)
+MIN_DELTA_MS = 0.05  # Smallest latency change considered, as timings below that are noise
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.2) -> list:
+    """Finds the measurements that got worse by more than a threshold
+
+    Args:
+        baseline: A dictionary representing the results of the baseline, in the form of
+            {"results": {name: measurements}}
+        current: A dictionary representing the results to check, in the same form
+        threshold: A float representing the largest accepted relative increase, such as 0.2 for
+            20%. Defaults to 0.2
+
+    Returns:
+        A list containing strings that describe the regressions
+    """
+    regressions = []
+    for name, measurements in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for key in LOWER_IS_BETTER:
+            if key not in measurements or key not in base:
+                continue
+            old, new = base[key], measurements[key]
+            if key.endswith("_ms") and new - old < MIN_DELTA_MS:
+                continue
+            if new > old * (1 + threshold):
+                change = f"+{(new - old) / old:.0%}" if old else "new"
+                regressions.append(f"{name}: {key} {old:.3f} -> {new:.3f} ({change})")
+    return regressions
@@ -0,0 +1,152 @@
+"""HTTP load test of the mobile API
+
+Clients poll the home feed of random students (replaying the ETag of their last response, as
+the app does), view posts and fetch badges, from many threads at once, for a fixed duration. The
+app is started in this process unless the URL of a running server (such as gunicorn) is given.
+The number of MongoDB commands per request is read from the server's /metrics.
+"""
+import logging
+import random
+import re
+import threading
+from time import perf_counter
+
+import requests
+
+from benchmarks.micro import percentile
+
+SCENARIO = (  # (weight, name)
+    (6, "home"),
+    (2, "home todo"),
+    (1, "view"),
+    (1, "badge"),
+)
+
+
+def start_server() -> str:
+    """Starts the app in a background thread
+
+    Returns:
+        A string representing the URL of the server
+    """
+    from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+
+    import app  # pylint: disable=import-outside-toplevel
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # Do not log every request
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def mongo_commands(url: str) -> dict:
+    """Reads the number of requests and MongoDB commands per route from /metrics
+
+    Args:
+        url: A string representing the URL of the server
+
+    Returns:
+        A dictionary in the form of {route: [commands, requests]}
+    """
+    totals = {}
+    text = requests.get(f"{url}/metrics", timeout=30).text
+    for kind, route, value in re.findall(
+        r'^http_request_mongo_commands_(sum|count)\{route="([^"]*)"\} (\S+)$', text, re.M
+    ):
+        totals.setdefault(route, [0.0, 0.0])[kind == "count"] += float(value)
+    return totals
+
+
+def client(url: str, fixtures: dict, deadline: float, seed: int, log: list):
+    """Runs one client until the deadline
+
+    Args:
+        url: A string representing the URL of the server
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        deadline: A float representing the perf_counter value to stop at
+        seed: An integer representing the seed of the client's random choices
+        log: A list to append tuples in the form of (name, seconds, status) to
+    """
+    rng = random.Random(seed)
+    session = requests.Session()
+    etags = {}  # {(username, todo): etag}
+    names = [name for weight, name in SCENARIO for _ in range(weight)]
+    while perf_counter() < deadline:
+        name = rng.choice(names)
+        username = rng.choice(fixtures["students"][:1000])
+        start = perf_counter()
+        if name.startswith("home"):
+            todo = int(name == "home todo")
+            response = session.get(
+                f"{url}/api/posts/home",
+                params={"username": username, "page": 1, "todo": todo},
+                headers={"If-None-Match": etags.get((username, todo), "")},
+                timeout=30,
+            )
+            if etag := response.headers.get("ETag"):
+                etags[(username, todo)] = etag
+            if response.status_code == 304:
+                name += " (unchanged)"
+        elif name == "view":
+            response = session.get(
+                f"{url}/api/posts/view",
+                params={"username": username, "id": str(fixtures["unviewed_post"])},
+                timeout=30,
+            )
+        else:
+            response = session.get(
+                f"{url}/api/users/badge", params={"username": username}, timeout=30
+            )
+        log.append((name, perf_counter() - start, response.status_code))
+
+
+def run(  # pylint: disable=too-many-locals
+    fixtures: dict, url: str = None, clients: int = 50, duration: float = 30.0
+) -> dict:
+    """Runs the load test
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        url: A string representing the URL of a running server, or None to start the app in this
+            process. Defaults to None
+        clients: An integer representing the number of concurrent clients. Defaults to 50
+        duration: A float representing the number of seconds to run for. Defaults to 30
+
+    Returns:
+        A dictionary in the form of {name: measurements}, with a "total" entry, where the
+        measurements contain "requests", "errors", "p50_ms", "p99_ms", "throughput_rps" and,
+        for the routes, "ops_per_request"
+    """
+    url = url or start_server()
+    before = mongo_commands(url)
+    log = []
+    deadline = perf_counter() + duration
+    threads = [
+        threading.Thread(target=client, args=(url, fixtures, deadline, seed, log))
+        for seed in range(clients)
+    ]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    after = mongo_commands(url)
+
+    results = {}
+    for name in sorted({entry[0] for entry in log}) + ["total"]:
+        entries = [entry for entry in log if name in ("total", entry[0])]
+        durations = [entry[1] for entry in entries]
+        results[name] = {
+            "requests": len(entries),
+            "errors": sum(1 for entry in entries if entry[2] >= 400),
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+            "throughput_rps": len(entries) / elapsed,
+        }
+    for route, (commands, requests_) in after.items():
+        commands -= before.get(route, [0.0, 0.0])[0]
+        requests_ -= before.get(route, [0.0, 0.0])[1]
+        if requests_ and route != "/metrics":
+            results[f"route {route}"] = {"ops_per_request": commands / requests_}
+    return results
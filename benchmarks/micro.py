@@ -0,0 +1,372 @@
+"""Micro-benchmarks of helper.py
+
+Every benchmark calls a helper function repeatedly against the seeded database (see seed.py) and
+reports its latency percentiles and the number of MongoDB commands per call, counted by the
+command listener of metrics.py. Benchmarks that write run last, since they change the data.
+"""
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from bson.json_util import dumps
+
+import badges
+import export
+import feed
+import helper
+import inbox
+import metrics
+import receipts
+import request_profiler
+from autocomplete import GroupIndex
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Gets a percentile of values, by the nearest-rank method
+
+    Args:
+        values: A list containing numbers, which must not be empty
+        fraction: A float between 0 and 1 representing the percentile, such as 0.99
+
+    Returns:
+        The value at the percentile
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarise(durations: list, commands: int = 0) -> dict:
+    """Summarises the durations of calls
+
+    Args:
+        durations: A list containing floats representing the duration of each call, in seconds
+        commands: An integer representing the number of MongoDB commands of all calls. Defaults
+            to 0
+
+    Returns:
+        A dictionary containing "calls", "p50_ms", "p99_ms", "mean_ms" and "ops_per_call"
+    """
+    return {
+        "calls": len(durations),
+        "p50_ms": percentile(durations, 0.5) * 1000,
+        "p99_ms": percentile(durations, 0.99) * 1000,
+        "mean_ms": sum(durations) / len(durations) * 1000,
+        "ops_per_call": commands / len(durations),
+    }
+
+
+def measure(function, repeat: int, warmup: int = 3) -> dict:
+    """Measures a function
+
+    Args:
+        function: A function that takes no arguments. Its result is discarded, so generators
+            must be consumed inside it
+        repeat: An integer representing the number of measured calls
+        warmup: An integer representing the number of calls before measuring. Defaults to 3
+
+    Returns:
+        A dictionary representing the measurements (see summarise)
+    """
+    for _ in range(warmup):
+        function()
+    durations, commands = [], 0
+    for _ in range(repeat):
+        metrics.begin_request("benchmark")
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+        commands += metrics.end_request()
+    return summarise(durations, commands)
+
+
+def cursor_at(username: str, pages: int) -> str:
+    """Gets the cursor to a deep page of a user's feed
+
+    Args:
+        username: A string representing the username of the user
+        pages: An integer representing the number of pages to skip
+
+    Returns:
+        A string representing the cursor, or None if the feed is shorter
+    """
+    cursor = None
+    for _ in range(pages):
+        posts = helper.get_posts(username, 1, False, cursor)
+        if not (cursor := feed.next_cursor(posts)):
+            break
+    return cursor
+
+
+def race_receipts(usernames: list, post_id: str) -> int:
+    """Views and responds to a post for every user at once, from concurrent threads
+
+    Args:
+        usernames: A list containing strings representing the usernames of the users, which must
+            not have viewed the post yet
+        post_id: A string representing the id of the post
+
+    Returns:
+        An integer representing the number of the users whose response was stored
+    """
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        list(
+            executor.map(
+                lambda pair: receipts.respond_post(pair[0], post_id, True)
+                if pair[1] % 2
+                else receipts.view_post(pair[0], post_id),
+                [(username, i) for username in usernames for i in range(2)],
+            )
+        )
+    if receipts.receipt_buffer:
+        receipts.receipt_buffer.flush()
+    return helper.db["receipts"].count_documents(
+        {"post_id": helper.ObjectId(post_id), "username": {"$in": usernames}, "response": True}
+    )
+
+
+def read_benchmarks(fixtures: dict, repeat: int) -> dict:
+    """Runs the benchmarks that only read
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        repeat: An integer representing the number of measured calls per benchmark
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    student, teacher, query = fixtures["student"], fixtures["teacher"], fixtures["query"]
+    results = {
+        "get_posts": measure(lambda: helper.get_posts(student, 1, False), repeat),
+        "get_posts todo": measure(lambda: helper.get_posts(student, 1, True), repeat),
+        "feed_etag (unchanged poll)": measure(lambda: helper.feed_etag(student, 1, 0), repeat),
+        "get_badge": measure(lambda: badges.get_badge(student), repeat),
+    }
+    if deep_cursor := cursor_at(student, 20):
+        results["get_posts page 21 by cursor"] = measure(
+            lambda: helper.get_posts(student, 1, False, deep_cursor), repeat
+        )
+    results["get_posts page 21 by skip"] = measure(
+        lambda: helper.get_posts(student, 21, False), repeat
+    )
+
+    for count, post_id in fixtures["viewer_posts"].items():
+        results.update(viewer_feed_benchmarks(fixtures, int(count), post_id, repeat))
+        results[f"get_post {count} viewers"] = measure(
+            lambda post_id=post_id: helper.get_post(str(post_id)), repeat
+        )
+        results[f"get_roster {count} viewers"] = measure(
+            lambda post_id=post_id: helper.get_roster(str(post_id)), repeat
+        )
+        results[f"download_post csv {count} viewers"] = measure(
+            lambda post_id=post_id: sum(
+                len(chunk) for chunk in export.to_csv(helper.download_post(str(post_id)))
+            ),
+            max(1, repeat // 10),
+            warmup=1,
+        )
+
+    def search_cold(rank):
+        helper.search_cache.clear()
+        return helper.search_for_post(teacher, query, 1, rank=rank)
+
+    results["search_for_post page 1 (cold)"] = measure(lambda: search_cold("recent"), repeat)
+    results["search_for_post page 10 (cached)"] = measure(
+        lambda: helper.search_for_post(teacher, query, 10), repeat
+    )
+    results["search_for_post page 1 by relevance (cold)"] = measure(
+        lambda: search_cold("relevance"), repeat
+    )
+
+    if helper.db["inbox"].estimated_document_count():  # Seeded with INBOX set
+        enabled = inbox.INBOX
+        try:
+            for inbox.INBOX in (False, True):
+                name = "inbox" if inbox.INBOX else "posts"
+                results[f"get_posts from {name}"] = measure(
+                    lambda: helper.get_posts(student, 1, False), repeat
+                )
+                results[f"get_posts todo from {name}"] = measure(
+                    lambda: helper.get_posts(student, 1, True), repeat
+                )
+        finally:
+            inbox.INBOX = enabled
+
+    prefix = fixtures["group_prefix"]
+    results["search_for_group"] = measure(
+        lambda: helper.search_for_group(teacher, prefix, suggestion=True), repeat * 10
+    )
+    return results
+
+
+def viewer_feed_benchmarks(fixtures: dict, count: int, post_id, repeat: int) -> dict:
+    """Benchmarks the home feed and search of a member of a group of count viewers
+
+    The feed and the search results include the group's post, which has been viewed by every
+    member, so their bytes show whether a post's size grows with its audience.
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        count: An integer representing the number of members of the group, in seed.VIEWER_COUNTS
+        post_id: An ObjectId representing the id of the group's post
+        repeat: An integer representing the number of measured calls per benchmark
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    member = fixtures["students"][count - 1]  # The groups hold the first count students
+    query = helper.db["posts"].find_one({"_id": post_id}, {"title": 1})["title"]
+    page_size = feed.MAX_PAGE_SIZE
+
+    def search_cold():
+        helper.search_cache.clear()
+        return helper.search_for_post(member, query, 1, page_size=page_size)
+
+    posts = helper.get_posts(member, 1, False, None, page_size)
+    found = search_cold()
+    return {
+        f"get_posts member of {count} viewers": dict(
+            measure(lambda: helper.get_posts(member, 1, False, None, page_size), repeat),
+            bytes=len(dumps(posts)),
+        ),
+        f"search_for_post member of {count} viewers (cold)": dict(
+            measure(search_cold, repeat), bytes=len(dumps(found))
+        ),
+    }
+
+
+def index_benchmarks(repeat: int, groups: int = 10000) -> dict:
+    """Benchmarks the autocomplete index on its own, with synthetic groups
+
+    Args:
+        repeat: An integer representing the number of measured calls per benchmark
+        groups: An integer representing the number of groups to index. Defaults to 10000
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    subjects = ["Biology", "Chemistry", "Physics", "Mathematics", "English", "History"]
+    documents = [
+        {
+            "_id": helper.ObjectId(),
+            "name": f"{2020 + i % 3} Y{1 + i % 6} {subjects[i % len(subjects)]} {i}",
+            "owners": [f"teacher{i % 20}"],
+        }
+        for i in range(groups)
+    ]
+    index = GroupIndex(lambda: documents)
+    start = perf_counter()
+    index.search("teacher0", "bio")
+    results = {f"autocomplete load {groups} groups": summarise([perf_counter() - start])}
+
+    def uncached(query):
+        index._cache.clear()  # pylint: disable=protected-access
+        return index.search("teacher0", query)
+
+    results[f"autocomplete prefix {groups} groups"] = measure(lambda: uncached("bio"), repeat)
+    results[f"autocomplete substring {groups} groups"] = measure(lambda: uncached("iolo"), repeat)
+    results[f"autocomplete cached {groups} groups"] = measure(
+        lambda: index.search("teacher0", "bio"), repeat * 10
+    )
+    return results
+
+
+def overhead_benchmarks(repeat: int) -> dict:
+    """Benchmarks fixed costs: importing the app, and checking for profiling when it is disabled
+
+    Args:
+        repeat: An integer representing the number of measured calls per benchmark
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    durations = []
+    for _ in range(max(1, repeat // 10)):
+        start = perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import app"],
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        durations.append(perf_counter() - start)
+    results = {"import app": summarise(durations)}
+
+    token, request_profiler.PROFILE_TOKEN = request_profiler.PROFILE_TOKEN, None
+    try:
+        results["profiling check (disabled)"] = measure(
+            lambda: request_profiler.requested(None, None), repeat * 100
+        )
+    finally:
+        request_profiler.PROFILE_TOKEN = token
+    return results
+
+
+def write_benchmarks(fixtures: dict, repeat: int) -> dict:
+    """Runs the benchmarks that write, which change the seeded data
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        repeat: An integer representing the number of measured calls per benchmark
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    students = fixtures["students"]
+    post_id = str(fixtures["unviewed_post"])
+    results = {}
+
+    viewers = iter(students)
+    results["view_post"] = measure(lambda: receipts.view_post(next(viewers), post_id), repeat)
+    results["respond_post"] = measure(
+        lambda: receipts.respond_post(next(viewers), post_id, True), repeat
+    )
+
+    concurrent = students[2 * (repeat + 3) : 2 * (repeat + 3) + 1000]
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        list(executor.map(lambda username: receipts.view_post(username, post_id), concurrent))
+    results["view_post 1000 concurrent"] = dict(
+        summarise([perf_counter() - start]), calls=len(concurrent)
+    )
+
+    # Concurrent first views and responses of the same users must not lose any acknowledgement,
+    # so the users must not have viewed the post yet
+    racing = students[2 * (repeat + 3) + 1000 : 2 * (repeat + 3) + 2000]
+    start = perf_counter()
+    responded = race_receipts(racing, post_id)
+    results["view_post and respond_post 1000 concurrent"] = dict(
+        summarise([perf_counter() - start]),
+        calls=2 * len(racing),
+        lost_responses=len(racing) - responded,
+    )
+
+    operations = [
+        {"op": "respond" if i % 2 else "view", "id": str(post_id), "response": True}
+        for post_id in helper.db["posts"]
+        .find({"group_id": {"$in": feed.group_ids_with_user(fixtures["student"])}}, {"_id": 1})
+        .limit(250)
+        for i in range(2)
+    ]
+    results["apply_receipts 500 operations"] = dict(
+        measure(lambda: receipts.apply_receipts(fixtures["student"], operations), repeat, warmup=0),
+        bytes=len(dumps(operations)),
+    )
+    return results
+
+
+def run(fixtures: dict, repeat: int = 50) -> dict:
+    """Runs every micro-benchmark against the seeded database
+
+    Args:
+        fixtures: A dictionary representing the fixtures, from seed.seed
+        repeat: An integer representing the number of measured calls per benchmark. Defaults to 50
+
+    Returns:
+        A dictionary in the form of {name: measurements}
+    """
+    results = read_benchmarks(fixtures, repeat)
+    results.update(index_benchmarks(repeat))
+    results.update(overhead_benchmarks(repeat))
+    results.update(write_benchmarks(fixtures, repeat))
+    return results
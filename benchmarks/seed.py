@@ -0,0 +1,214 @@
+"""Synthetic data for the benchmarks
+
+The school is made of teachers and students, class groups of 20 to 40 students, cohort groups of
+150 to 400 students, and posts whose receipts are filled to various levels. A few extra groups
+have exactly VIEWER_COUNTS members, each with one post viewed by all of them, to measure how
+the cost of a post grows with its audience. The largest of them also has a post viewed by no one,
+for the benchmarks of views. The same seed always gives the same school, apart from the ids.
+"""
+import random
+from time import time
+
+import badges
+import helper
+import inbox
+import indexes
+
+CLASS_SIZE = (20, 40)
+COHORT_SIZE = (150, 400)
+COHORT_SHARE = 0.1  # Share of groups that are cohorts
+TEACHER_SHARE = 0.05  # Share of users that are teachers
+ACKNOWLEDGEMENT_SHARE = 0.4  # Share of posts that require acknowledgement
+FILL_LEVELS = (0.0, 0.1, 0.5, 0.9, 1.0)  # Shares of a group's users that have viewed a post
+VIEWER_COUNTS = (10, 1000, 10000)
+CHUNK_SIZE = 10000  # Documents per insert_many
+
+SUBJECTS = ["Biology", "Chemistry", "Physics", "Mathematics", "English", "History", "Geography"]
+WORDS = (
+    "exam lesson remedial homework deadline reminder consent form trip camp assembly uniform "
+    "timetable change briefing project submission laboratory practical revision notes holiday"
+).split()
+
+
+def insert_chunks(collection, documents: list):
+    """Inserts documents in chunks of CHUNK_SIZE
+
+    Args:
+        collection: A pymongo.collection.Collection object to insert into
+        documents: A list containing dictionaries that represent the documents
+    """
+    for i in range(0, len(documents), CHUNK_SIZE):
+        collection.insert_many(documents[i : i + CHUNK_SIZE], ordered=False)
+
+
+def make_receipts(rng: random.Random, post: dict, usernames: list, fill: float) -> list:
+    """Makes the receipts of the users that viewed a post
+
+    Args:
+        rng: A random.Random object
+        post: A dictionary object that represents the post, with "_id", "date_created" and
+            "requires_acknowledgement"
+        usernames: A list containing strings that represent the usernames of the post's audience
+        fill: A float representing the share of the audience that has viewed the post
+
+    Returns:
+        A list containing dictionaries that represent the receipts
+    """
+    receipts = []
+    for username in rng.sample(usernames, int(len(usernames) * fill)):
+        response = None
+        if post["requires_acknowledgement"]:
+            response = rng.choice([True, True, True, False, None])
+        receipts.append(
+            {
+                "post_id": post["_id"],
+                "username": username,
+                "response": response,
+                "pending": post["requires_acknowledgement"] and response is None,
+                "date_viewed": post["date_created"] + rng.randint(60, 86400),
+                "date_modified": (post["date_created"] + 86400) * 1000,
+            }
+        )
+    return receipts
+
+
+def make_post(rng: random.Random, group: dict, now: int, requires_acknowledgement=None) -> dict:
+    """Makes a post in a group
+
+    Args:
+        rng: A random.Random object
+        group: A dictionary object that represents the group, with "_id", "owners" and "name"
+        now: An integer representing the current time, in seconds
+        requires_acknowledgement: A boolean value, or None to choose at random. Defaults to None
+
+    Returns:
+        A dictionary representing the post
+    """
+    if requires_acknowledgement is None:
+        requires_acknowledgement = rng.random() < ACKNOWLEDGEMENT_SHARE
+    date_created = now - rng.randint(0, 365 * 86400)
+    return {
+        "_id": helper.ObjectId(),
+        "title": " ".join(rng.choice(WORDS) for _ in range(4)).capitalize(),
+        "body": " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120))),
+        "group_id": group["_id"],
+        "location": None,
+        "requires_acknowledgement": requires_acknowledgement,
+        "date_due": date_created + 7 * 86400 if requires_acknowledgement else None,
+        "date_created": date_created,
+        "date_modified": date_created * 1000,
+        "author_id": group["owners"][0],
+    }
+
+
+def seed(  # pylint: disable=too-many-locals
+    database, users: int = 10000, groups: int = 500, posts: int = 20000, seed_: int = 0
+):
+    """Drops the benchmark database and fills it with a synthetic school
+
+    Args:
+        database: The LazyDatabase of helper.py
+        users: An integer representing the number of users. Defaults to 10000
+        groups: An integer representing the number of groups, besides those for VIEWER_COUNTS.
+            Defaults to 500
+        posts: An integer representing the number of posts, besides those for VIEWER_COUNTS.
+            Defaults to 20000
+        seed_: An integer representing the seed of the random number generator. Defaults to 0
+
+    Returns:
+        A dictionary representing the fixtures used by the benchmarks, which is also stored in
+        the "benchmark" collection
+
+    Raises:
+        ValueError: The database is the production database
+    """
+    if database.name == "students-gateway":
+        raise ValueError("Refusing to drop the production database, set MONGO_DATABASE")
+    rng = random.Random(seed_)
+    now = int(time())
+    database.client.drop_database(database.name)
+
+    teacher_count = max(1, int(users * TEACHER_SHARE))
+    teachers = [f"teacher{i}" for i in range(teacher_count)]
+    students = [f"student{i}" for i in range(users - teacher_count)]
+    salt = helper.generate_salt()
+    password_hash = helper.generate_hash("password", salt)
+    insert_chunks(
+        database["users"],
+        [
+            {
+                "username": username,
+                "name": username.capitalize(),
+                "salt": salt,
+                "password_hash": password_hash,
+                "user_type": "admin" if username.startswith("teacher") else "user",
+            }
+            for username in teachers + students
+        ],
+    )
+
+    group_docs = []
+    for i in range(groups):
+        size = COHORT_SIZE if rng.random() < COHORT_SHARE else CLASS_SIZE
+        group_docs.append(
+            {
+                "_id": helper.ObjectId(),
+                "name": f"{2020 + i % 3} Y{1 + i % 6} {rng.choice(SUBJECTS)} {i}",
+                "owners": rng.sample(teachers, min(len(teachers), rng.choice([1, 1, 2]))),
+                "members": rng.sample(students, min(len(students), rng.randint(*size))),
+            }
+        )
+    viewer_groups = {}
+    for count in VIEWER_COUNTS:
+        viewer_groups[count] = {
+            "_id": helper.ObjectId(),
+            "name": f"Viewers {count}",
+            "owners": [teachers[0]],
+            "members": students[:count],
+        }
+    insert_chunks(database["groups"], group_docs + list(viewer_groups.values()))
+
+    post_docs, receipts = [], []
+    for _ in range(posts):
+        group = rng.choice(group_docs)
+        post = make_post(rng, group, now)
+        post_docs.append(post)
+        receipts += make_receipts(rng, post, group["members"], rng.choice(FILL_LEVELS))
+    viewer_posts = {}
+    for count, group in viewer_groups.items():
+        post = make_post(rng, group, now, requires_acknowledgement=True)
+        post_docs.append(post)
+        receipts += make_receipts(rng, post, group["members"], 1.0)
+        viewer_posts[str(count)] = post["_id"]
+    unviewed_post = make_post(rng, viewer_groups[max(VIEWER_COUNTS)], now, True)
+    post_docs.append(unviewed_post)
+    insert_chunks(database["posts"], post_docs)
+    insert_chunks(database["receipts"], receipts)
+
+    indexes.ensure_indexes(database)
+    if inbox.INBOX:
+        inbox.backfill_inbox()
+    if badges.BADGES:
+        badges.reconcile_badges()
+
+    memberships = {}
+    for group in group_docs:
+        for username in group["members"]:
+            memberships[username] = memberships.get(username, 0) + 1
+    owned = {}
+    for group in group_docs:
+        for username in group["owners"]:
+            owned[username] = owned.get(username, 0) + 1
+    fixtures = {
+        "_id": "fixtures",
+        "student": max(memberships, key=memberships.get),
+        "teacher": max(owned, key=owned.get),
+        "students": students,
+        "query": "exam",
+        "group_prefix": SUBJECTS[0][:3].lower(),
+        "viewer_posts": viewer_posts,
+        "unviewed_post": unviewed_post["_id"],
+        "counts": {"users": users, "groups": len(group_docs), "posts": len(post_docs)},
+    }
+    database["benchmark"].insert_one(fixtures)
+    return fixtures
@@ -0,0 +1,439 @@
+"""Server-sent events of posts for asyncapi.py
+
+This module keeps the /api/posts/stream connections of one process, and pushes events to them
+when posts of their users' groups are created ("post_created"), updated ("post_updated") or
+deleted ("post_deleted"), or when users lose access to a group ("group_removed"). The events only
+name the post and the group, so that clients fetch the changes with their usual requests.
+
+The posts are written by every process of app.py and asyncapi.py, so asyncapi.py reads the
+changes of the posts and deletions collections from the database. On a replica set, it reads
+them through a change stream (see watch_changes). On a standalone server, which has no change
+streams, it polls both collections every STREAM_POLL seconds instead (see poll_changes), so
+events arrive later but still from every process. Every process also publishes the posts written
+through helper.py to its own broker (see Broker.publish_threadsafe), but these events are ignored
+while the changes are read from the database, so that they are not sent twice.
+
+Every connection has a bounded queue. A client that does not read its events fast enough is sent
+an "evicted" event and disconnected, instead of the queue growing without limit. The broker
+remembers its last STREAM_HISTORY events, so that a client reconnecting with the Last-Event-ID
+header is sent the events it missed, or a "reset" event if they are no longer known (for example,
+after reconnecting to another worker), after which it should fetch its feed again.
+"""
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+from collections import deque
+from secrets import token_hex
+from time import time
+
+import pymongo
+from bson.json_util import dumps
+
+STREAM_HISTORY = int(os.getenv("STREAM_HISTORY", "1000"))  # Number of events kept for resuming
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "100"))  # Pending events per connection
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "15"))  # Seconds between heartbeats
+STREAM_POLL = float(os.getenv("STREAM_POLL", "1"))  # Seconds between polls, without a replica set
+STREAM_POLL_LAG = int(os.getenv("STREAM_POLL_LAG", "5000"))  # Milliseconds each poll looks back
+STREAM_RETRY = 5000  # Milliseconds for clients to wait before reconnecting
+
+HEARTBEAT = ": heartbeat\n\n"
+RESET = "event: reset\ndata: {}\n\n"
+EVICTED = "event: evicted\ndata: {}\n\n"
+NOT_REPLICA_SET = 40573  # Error code of change streams on a standalone server
+HISTORY_LOST = (280, 286)  # Error codes of change streams that can no longer be resumed
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:  # pylint: disable=too-few-public-methods
+    """The events pending for one connection
+
+    Attributes:
+        username: A string representing the username of the user
+        group_ids: A frozenset containing ObjectIds that represent the ids of the user's groups
+        queue: An asyncio.Queue object containing the pending messages, as strings
+        evicted: A boolean value indicating if the connection was evicted for reading too slowly
+    """
+
+    def __init__(self, username: str, group_ids, max_size: int):
+        self.username = username
+        self.group_ids = frozenset(group_ids)
+        self.queue = asyncio.Queue(max_size)
+        self.evicted = False
+
+    def wants(self, group_id, usernames) -> bool:
+        """Checks if an event concerns the user
+
+        Args:
+            group_id: An ObjectId representing the id of the group of the event
+            usernames: A tuple containing strings that represent the usernames the event is for,
+                or None if it is for every user of the group
+
+        Returns:
+            A boolean value indicating if the event should be sent to the user
+        """
+        if usernames is not None:
+            return self.username in usernames
+        return group_id in self.group_ids
+
+
+class Broker:  # pylint: disable=too-many-instance-attributes
+    """Publishes events to the subscriptions of one process
+
+    Subscriptions are indexed by group and by username, so that publishing an event only visits
+    the connections that receive it. All methods but publish_threadsafe must be called from the
+    event loop given to attach.
+
+    Attributes:
+        history: A deque containing the last events, as tuples in the form of
+            (sequence, group_id, usernames, message)
+        queue_size: An integer representing the number of pending events per connection
+        local: A boolean value indicating if events published by this process are delivered.
+            It is False while the changes are read from the database instead
+    """
+
+    def __init__(self, history: int = STREAM_HISTORY, queue_size: int = STREAM_QUEUE_SIZE):
+        self.history = deque(maxlen=history)
+        self.queue_size = queue_size
+        self.local = True
+        self._prefix = token_hex(4)  # Distinguishes the event ids of this process
+        self._sequence = itertools.count(1)
+        self._loop = None
+        self._by_group = {}  # {group_id: {subscription}}
+        self._by_user = {}  # {username: {subscription}}
+        self._stats = {"published": 0, "evictions": 0, "resets": 0}
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Sets the event loop that the subscriptions run in
+
+        Until it is called, events are discarded, so processes without streams do not keep any.
+
+        Args:
+            loop: The asyncio event loop of the server
+        """
+        self._loop = loop
+
+    def subscribe(self, username: str, group_ids, last_event_id: str = None) -> Subscription:
+        """Opens a subscription for a user
+
+        Args:
+            username: A string representing the username of the user
+            group_ids: An iterable of ObjectIds representing the ids of the user's groups
+            last_event_id: A string representing the id of the last event the client received,
+                from the Last-Event-ID header, or None for a new stream. Defaults to None
+
+        Returns:
+            A Subscription object, with the missed events, if any, already queued
+        """
+        subscription = Subscription(username, group_ids, self.queue_size)
+        self._by_user.setdefault(username, set()).add(subscription)
+        for group_id in subscription.group_ids:
+            self._by_group.setdefault(group_id, set()).add(subscription)
+        if last_event_id is not None:
+            self._replay(subscription, last_event_id)
+        return subscription
+
+    def update(self, subscription: Subscription, group_ids):
+        """Changes the groups of a subscription, after the user joined or left groups
+
+        Args:
+            subscription: The Subscription object to update
+            group_ids: An iterable of ObjectIds representing the ids of the user's groups
+        """
+        group_ids = frozenset(group_ids)
+        if subscription.evicted or group_ids == subscription.group_ids:
+            return
+        for group_id in subscription.group_ids - group_ids:
+            self._discard(self._by_group, group_id, subscription)
+        for group_id in group_ids - subscription.group_ids:
+            self._by_group.setdefault(group_id, set()).add(subscription)
+        subscription.group_ids = group_ids
+
+    def unsubscribe(self, subscription: Subscription):
+        """Closes a subscription. Closing it more than once does nothing
+
+        Args:
+            subscription: The Subscription object to close
+        """
+        self._discard(self._by_user, subscription.username, subscription)
+        for group_id in subscription.group_ids:
+            self._discard(self._by_group, group_id, subscription)
+
+    def publish(self, event: str, group_id, post_id=None, usernames=None, local: bool = False):
+        """Sends an event to the subscriptions it concerns
+
+        Args:
+            event: A string representing the type of the event, such as "post_created"
+            group_id: An ObjectId representing the id of the group
+            post_id: An ObjectId representing the id of the post, if any. Defaults to None
+            usernames: A list containing strings that represent the usernames the event is for,
+                or None if it is for every user of the group. Defaults to None
+            local: A boolean value indicating if the event was published by this process rather
+                than read from the database. Defaults to False
+        """
+        if local and not self.local:
+            return
+        sequence = next(self._sequence)
+        data = {"group_id": group_id}
+        if post_id is not None:
+            data["post_id"] = post_id
+        message = f"id: {self._prefix}-{sequence}\nevent: {event}\ndata: {dumps(data)}\n\n"
+        usernames = tuple(usernames) if usernames is not None else None
+        self.history.append((sequence, group_id, usernames, message))
+        self._stats["published"] += 1
+        if usernames is not None:
+            recipients = [
+                subscription
+                for username in usernames
+                for subscription in self._by_user.get(username, ())
+            ]
+        else:
+            recipients = list(self._by_group.get(group_id, ()))
+        for subscription in recipients:
+            self._deliver(subscription, message)
+
+    def publish_threadsafe(self, event: str, group_id, post_id=None, usernames=None):
+        """Publishes an event written by this process, from any thread
+
+        Args:
+            See publish
+        """
+        if self._loop is None or not self.local:
+            return
+        try:
+            self._loop.call_soon_threadsafe(
+                lambda: self.publish(event, group_id, post_id, usernames, local=True)
+            )
+        except RuntimeError:  # The event loop is closed
+            pass
+
+    def reset(self):
+        """Sends a "reset" event to every subscription, after events may have been lost"""
+        self.history.clear()
+        for subscriptions in list(self._by_user.values()):
+            for subscription in list(subscriptions):
+                self._deliver(subscription, RESET)
+                self._stats["resets"] += 1
+
+    async def messages(self, subscription: Subscription, refresh=None, heartbeat: float = None):
+        """Yields the messages of a subscription, in the text/event-stream format
+
+        A heartbeat comment is sent whenever there has been no event for heartbeat seconds, which
+        keeps proxies from closing idle connections. The subscription is closed when the client
+        disconnects or is evicted.
+
+        Args:
+            subscription: The Subscription object to read
+            refresh: An async function that returns the current group ids of the user, called
+                after every heartbeat, or None. Defaults to None
+            heartbeat: A float representing the number of seconds between heartbeats. Defaults
+                to STREAM_HEARTBEAT
+
+        Yields:
+            Strings representing the messages
+        """
+        try:
+            yield f"retry: {STREAM_RETRY}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.queue.get(), heartbeat or STREAM_HEARTBEAT
+                    )
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+                    if refresh is not None:
+                        self.update(subscription, await refresh())
+                    continue
+                yield message
+                if message is EVICTED:
+                    return
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        """Gets statistics on the broker
+
+        Returns:
+            A dictionary containing "connections", "published", "evictions" and "resets"
+        """
+        connections = sum(len(subscriptions) for subscriptions in self._by_user.values())
+        return dict(self._stats, connections=connections)
+
+    def _replay(self, subscription: Subscription, last_event_id: str):
+        prefix, _, sequence = last_event_id.partition("-")
+        if (
+            prefix != self._prefix
+            or not sequence.isdigit()
+            or (self.history and int(sequence) < self.history[0][0] - 1)
+        ):
+            self._deliver(subscription, RESET)
+            self._stats["resets"] += 1
+            return
+        for entry_sequence, group_id, usernames, message in self.history:
+            if entry_sequence > int(sequence) and subscription.wants(group_id, usernames):
+                self._deliver(subscription, message)
+
+    def _deliver(self, subscription: Subscription, message: str):
+        if subscription.evicted:
+            return
+        try:
+            subscription.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            subscription.evicted = True
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(EVICTED)
+            self.unsubscribe(subscription)
+            self._stats["evictions"] += 1
+
+    @staticmethod
+    def _discard(index: dict, key, subscription: Subscription):
+        subscriptions = index.get(key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+
+def publish_document(broker: Broker, collection: str, document: dict, created: bool = False):
+    """Publishes the event of a document written to the posts or deletions collections
+
+    Args:
+        broker: The Broker object to publish to
+        collection: A string representing the name of the collection, "posts" or "deletions"
+        document: A dictionary representing the document
+        created: A boolean value indicating if the post was created rather than updated.
+            Defaults to False
+    """
+    if collection == "posts":
+        event = "post_created" if created else "post_updated"
+        broker.publish(event, document["group_id"], document["_id"])
+    elif "post_id" in document:
+        broker.publish("post_deleted", document["group_id"], document["post_id"])
+    else:
+        broker.publish("group_removed", document["group_id"], usernames=document["usernames"])
+
+
+def publish_change(broker: Broker, change: dict):
+    """Publishes a change of the posts or deletions collections, from a change stream
+
+    Args:
+        broker: The Broker object to publish to
+        change: A dictionary representing the change event, with its full document
+    """
+    document = change.get("fullDocument")
+    if document is None:  # Deleted before the change was read
+        return
+    publish_document(broker, change["ns"]["coll"], document, change["operationType"] == "insert")
+
+
+async def read_changes(database, since: int) -> list:
+    """Reads the posts modified and the deletions logged since a time, for poll_changes
+
+    Args:
+        database: A motor.motor_asyncio.AsyncIOMotorDatabase object to read
+        since: An integer representing the time, in milliseconds since the epoch
+
+    Returns:
+        A list containing tuples in the form of (time, collection, document), sorted by time,
+        where time is the date_modified of a post or the date_deleted of a deletion
+    """
+    posts = database["posts"].find(
+        {"date_modified": {"$gt": since}},
+        {"group_id": 1, "date_created": 1, "date_modified": 1},
+    )
+    changes = [(post["date_modified"], "posts", post) async for post in posts]
+    deleted_at = datetime.datetime.fromtimestamp(since / 1000, datetime.timezone.utc)
+    deletions = database["deletions"].find(  # deleted_at is indexed, for the TTL
+        {"deleted_at": {"$gt": deleted_at}}, {"deleted_at": 0}
+    )
+    changes += [(deletion["date_deleted"], "deletions", deletion) async for deletion in deletions]
+    return sorted(changes, key=lambda change: change[0])
+
+
+async def poll_changes(broker: Broker, database, interval: float = None, lag: int = None):
+    """Publishes the changes of posts and deletions, read by polling, until cancelled
+
+    This replaces watch_changes on a standalone server. The writes of other processes can become
+    visible after later ones, and their clocks differ, so every poll looks back lag milliseconds
+    before the latest change it has seen and skips the changes it has already published. A post
+    counts as created if it was last modified within half a second of its date_created, which is
+    rounded to the second, so an update right after the creation is sent as "post_created".
+
+    Args:
+        broker: The Broker object to publish to
+        database: A motor.motor_asyncio.AsyncIOMotorDatabase object to poll
+        interval: A float representing the number of seconds between polls. Defaults to
+            STREAM_POLL
+        lag: An integer representing the number of milliseconds each poll looks back. Defaults
+            to STREAM_POLL_LAG
+    """
+    interval = interval or STREAM_POLL
+    lag = STREAM_POLL_LAG if lag is None else lag
+    latest = int(time() * 1000)
+    published = {}  # {(collection, _id, time): time}
+    broker.local = False
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changes = await read_changes(database, latest - lag)
+        except pymongo.errors.PyMongoError as error:
+            logger.warning("Polling changes failed: %s", error)
+            continue
+        for stamp, collection, document in changes:
+            key = (collection, document["_id"], stamp)
+            if key in published:
+                continue
+            published[key] = stamp
+            created = collection == "posts" and stamp - document["date_created"] * 1000 <= 500
+            publish_document(broker, collection, document, created)
+            latest = max(latest, stamp)
+        for key in [key for key, stamp in published.items() if stamp <= latest - lag]:
+            del published[key]
+
+
+async def watch_changes(broker: Broker, database, retry: float = 1.0):
+    """Publishes the changes of posts and deletions, read from a change stream, until cancelled
+
+    Posts are deleted through the deletions collection (see sync.log_deletion), which records
+    their group. While the stream is open, the broker ignores the events of its own process. If
+    the database is not a replica set, this polls the collections instead (see poll_changes).
+
+    Args:
+        broker: The Broker object to publish to
+        database: A motor.motor_asyncio.AsyncIOMotorDatabase object to watch
+        retry: A float representing the number of seconds to wait before reopening the stream
+            after an error. Defaults to 1
+    """
+    pipeline = [
+        {
+            "$match": {
+                "ns.coll": {"$in": ["posts", "deletions"]},
+                "operationType": {"$in": ["insert", "update", "replace"]},
+            }
+        }
+    ]
+    resume_after = None
+    while True:
+        try:
+            async with database.watch(
+                pipeline, full_document="updateLookup", resume_after=resume_after
+            ) as stream:
+                broker.local = False
+                async for change in stream:
+                    resume_after = change["_id"]
+                    publish_change(broker, change)
+        except pymongo.errors.OperationFailure as error:
+            if error.code == NOT_REPLICA_SET:
+                logger.info("Change streams are not available, polling for changes instead")
+                await poll_changes(broker, database)
+                return
+            if error.code in HISTORY_LOST:
+                resume_after = None
+                broker.reset()
+            logger.warning("Change stream failed: %s", error)
+        except pymongo.errors.PyMongoError as error:
+            logger.warning("Change stream interrupted: %s", error)
+        await asyncio.sleep(retry)
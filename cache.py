@@ -0,0 +1,156 @@
+"""Caches for helper.py
+
+This module provides the in-process caches used by helper.py. Each gunicorn worker has its own
+caches, so entries are also given a time to live, after which changes made through other workers
+become visible.
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache:
+    """A thread-safe cache whose entries expire after a time to live
+
+    Attributes:
+        ttl: A float representing the number of seconds an entry stays valid
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}  # {key: (expiry, value)}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        """Gets the value of a key
+
+        Args:
+            key: The key to get
+
+        Returns:
+            The value of the key, or None if the key is not cached or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                self._entries.pop(key, None)
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Sets the value of a key
+
+        Args:
+            key: The key to set
+            value: The value of the key, which must not be None
+        """
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+
+    def get_many(self, keys, fetch) -> dict:
+        """Gets the values of several keys, fetching the missing ones together
+
+        Args:
+            keys: An iterable of the keys to get
+            fetch: A function that is called with a list of the keys that are not cached, and
+                returns a dictionary in the form of {key: value} (for example, with one $in query)
+
+        Returns:
+            A dictionary in the form of {key: value}. Keys that fetch did not return are left out
+        """
+        values, missing = self._get_cached(keys)
+        if missing:
+            values.update(self._set_fetched(fetch(missing)))
+        return values
+
+    async def get_many_async(self, keys, fetch) -> dict:
+        """Gets the values of several keys, like get_many, with a coroutine function as fetch
+
+        Args:
+            keys: An iterable of the keys to get
+            fetch: A coroutine function that is called with a list of the keys that are not
+                cached, and returns a dictionary in the form of {key: value}
+
+        Returns:
+            A dictionary in the form of {key: value}. Keys that fetch did not return are left out
+        """
+        values, missing = self._get_cached(keys)
+        if missing:
+            values.update(self._set_fetched(await fetch(missing)))
+        return values
+
+    def invalidate(self, keys):
+        """Removes keys from the cache
+
+        Args:
+            keys: An iterable of the keys to remove
+        """
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def clear(self):
+        """Removes all keys from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Gets statistics of the cache
+
+        Returns:
+            A dictionary containing "size", "hits", "misses" and "invalidations"
+        """
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
+
+
+    def _get_cached(self, keys) -> tuple:
+        values = {}
+        missing = []
+        for key in set(keys):
+            value = self.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        return values, missing
+
+    def _set_fetched(self, fetched: dict) -> dict:
+        for key, value in fetched.items():
+            self.set(key, value)
+        return fetched
+
+
+class LRUCache(TTLCache):
+    """A TTLCache that holds at most max_size entries, evicting the least recently used ones
+
+    Attributes:
+        ttl: A float representing the number of seconds an entry stays valid
+        max_size: An integer representing the largest number of entries held
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._stats["evictions"] = 0
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
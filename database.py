@@ -0,0 +1,160 @@
+"""Database connection for helper.py
+
+This module provides the MongoDB database used by helper.py. The client is only created on
+first use, and again in every process it is used in, so that gunicorn workers never share a
+client (and its sockets) created before they were forked.
+
+The client can be configured with the following environment variables:
+    MONGO_URI: Connection string. Defaults to the Atlas cluster, with DB_USERNAME and DB_PASSWORD
+    MONGO_DATABASE: Name of the database. Defaults to "students-gateway"
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE: Connection pool size. Default to 100 and 0
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS: Timeouts
+    MONGO_FEED_READ_PREFERENCE: Read preference of the feed queries, such as "secondaryPreferred"
+        (or "secondary_preferred"). Defaults to the read preference of the client, which is
+        "primary" unless MONGO_URI sets readPreference
+"""
+import os
+import threading
+
+import pymongo
+
+if os.path.isfile(".env"):  # for local testing
+    from dotenv import load_dotenv
+
+    load_dotenv(verbose=True)
+
+DATABASE_NAME = os.getenv("MONGO_DATABASE", "students-gateway")
+
+
+def mongo_uri() -> str:
+    """Gets the MongoDB connection string
+
+    Returns:
+        A string representing the connection string
+    """
+    if uri := os.getenv("MONGO_URI"):
+        return uri
+    return (
+        f"mongodb+srv://{os.environ['DB_USERNAME']}:{os.environ['DB_PASSWORD']}"
+        f"@cluster0.g9wex.gcp.mongodb.net/<dbname>?retryWrites=true&w=majority"
+    )
+
+
+def client_options() -> dict:
+    """Gets the options of the MongoDB client from the environment
+
+    Returns:
+        A dictionary containing keyword arguments for pymongo.MongoClient
+    """
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    }
+    for option, variable in (
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS"),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS"),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+    ):
+        if value := os.getenv(variable):
+            options[option] = int(value)
+    return options
+
+
+def feed_read_preference():
+    """Gets the read preference of the feed queries from the environment
+
+    Returns:
+        A pymongo.read_preferences read preference, or None to use the read preference of the
+        client
+
+    Raises:
+        ValueError: MONGO_FEED_READ_PREFERENCE is not a read preference mode
+    """
+    name = os.getenv("MONGO_FEED_READ_PREFERENCE")
+    if not name:
+        return None
+    modes = {
+        preference.mongos_mode.lower(): preference
+        for preference in (
+            pymongo.ReadPreference.PRIMARY,
+            pymongo.ReadPreference.PRIMARY_PREFERRED,
+            pymongo.ReadPreference.SECONDARY,
+            pymongo.ReadPreference.SECONDARY_PREFERRED,
+            pymongo.ReadPreference.NEAREST,
+        )
+    }
+    try:
+        return modes[name.replace("_", "").lower()]
+    except KeyError:
+        raise ValueError(
+            "MONGO_FEED_READ_PREFERENCE must be one of "
+            f"{', '.join(preference.mongos_mode for preference in modes.values())}, not {name!r}"
+        ) from None
+
+
+# Read once, so that an invalid value stops the app from starting
+FEED_READ_PREFERENCE = feed_read_preference()
+
+
+class LazyDatabase:
+    """A MongoDB database whose client is created on first use, once per process
+
+    Collections are accessed the same way as on pymongo.database.Database, with db[name].
+
+    Attributes:
+        name: A string representing the name of the database
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        """The pymongo.MongoClient object of the current process"""
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = pymongo.MongoClient(mongo_uri(), **client_options())
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getitem__(self, name: str):
+        return self.client[self.name][name]
+
+    def feed_collection(self, name: str):
+        """Gets a collection that uses the read preference for feed queries
+
+        Args:
+            name: A string representing the name of the collection
+
+        Returns:
+            A pymongo.collection.Collection object
+        """
+        return self.client[self.name].get_collection(name, read_preference=FEED_READ_PREFERENCE)
+
+
+class AsyncDatabase(LazyDatabase):
+    """A LazyDatabase whose client is a motor.motor_asyncio.AsyncIOMotorClient, for asyncapi.py
+
+    motor is only imported on first use, so that the synchronous app does not depend on it.
+    """
+
+    @property
+    def client(self):
+        """The motor.motor_asyncio.AsyncIOMotorClient object of the current process"""
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    import motor.motor_asyncio  # pylint: disable=import-outside-toplevel
+
+                    self._client = motor.motor_asyncio.AsyncIOMotorClient(
+                        mongo_uri(), **client_options()
+                    )
+                    self._pid = os.getpid()
+        return self._client
+
+
+db = LazyDatabase(DATABASE_NAME)
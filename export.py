@@ -0,0 +1,65 @@
+"""Export functions for app.py
+
+This module turns the rows yielded by helper.download_post into CSV or XLSX files, streamed in
+chunks so that the whole file is never held in memory.
+"""
+import csv
+import io
+import os
+import tempfile
+
+CHUNK_ROWS = 500  # Number of CSV rows per streamed chunk
+CHUNK_BYTES = 65536  # Number of XLSX bytes per streamed chunk
+
+
+def to_csv(rows):
+    """Formats rows as CSV
+
+    The output is the same as pandas.DataFrame.to_csv(index=False).
+
+    Args:
+        rows: An iterable of lists representing rows, starting with the header
+
+    Yields:
+        Strings containing the CSV, CHUNK_ROWS rows at a time
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def to_xlsx(rows):
+    """Formats rows as an XLSX workbook
+
+    The workbook is written with xlsxwriter's constant_memory mode, which flushes each row to a
+    temporary file as soon as it is written.
+
+    Args:
+        rows: An iterable of lists representing rows, starting with the header
+
+    Yields:
+        Bytes containing the XLSX file, CHUNK_BYTES at a time
+    """
+    import xlsxwriter  # pylint: disable=import-outside-toplevel
+
+    handle, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        worksheet = workbook.add_worksheet()
+        for i, row in enumerate(rows):
+            worksheet.write_row(i, 0, row)
+        workbook.close()
+
+        with open(path, "rb") as file:
+            while chunk := file.read(CHUNK_BYTES):
+                yield chunk
+    finally:
+        os.remove(path)
@@ -0,0 +1,395 @@
+# pylint: disable=consider-using-dict-comprehension
+"""The home feed, for helper.py and asyncapi.py
+
+This module provides the groups of a user, the names attached to posts, and the aggregation
+stages, cursors and formatting of pages of posts, which the other modules build on.
+"""
+import base64
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from cache import LRUCache, TTLCache
+from database import db
+
+PAGE_SIZE = 5  # Default number of posts per page
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "50"))  # Largest page size a client may request
+
+# {username: frozenset of ids of the groups the user owns or is a member of}
+membership_cache = TTLCache(float(os.getenv("MEMBERSHIP_CACHE_TTL", "60")))
+
+# {username: name} and {group_id: name}, for attaching names to posts
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "300"))
+user_name_cache = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+group_name_cache = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+
+def membership_filter(username: str) -> dict:
+    """Builds the filter on groups that matches the groups with user in it/them
+
+    Args:
+        username: A string representing the username of the user
+
+    Returns:
+        A dictionary representing the filter
+    """
+    return {"$or": [{"owners": username}, {"members": username}]}
+
+
+def group_ids_with_user(username: str) -> list:
+    """Finds the ids of the group(s) with user in it/them
+
+    The ids are cached per user for MEMBERSHIP_CACHE_TTL seconds, and the cache is invalidated by
+    helper.create_group, helper.update_group and helper.delete_group.
+
+    Args:
+        username: A string representing the username of the user
+
+    Returns:
+        A list containing ObjectIds that represent the ids of the groups that user is in
+    """
+    group_ids = membership_cache.get(username)
+    if group_ids is None:
+        group_ids = frozenset(
+            group["_id"] for group in db["groups"].find(membership_filter(username), {"_id": 1})
+        )
+        membership_cache.set(username, group_ids)
+    return list(group_ids)
+
+
+def invalidate_group(group: dict):
+    """Invalidates the cached data of the users of a group
+
+    Args:
+        group: A dictionary object that represents the group, with "owners" and "members"
+    """
+    membership_cache.invalidate(group.get("owners", []) + group.get("members", []))
+
+
+def user_names(usernames: list) -> dict:
+    """Gets the names of users, from the cache or with a single query for the missing ones
+
+    Args:
+        usernames: A list containing strings that represent the usernames of the users
+
+    Returns:
+        A dictionary in the form of {username: name}
+    """
+    return user_name_cache.get_many(
+        usernames,
+        lambda missing: dict(
+            [
+                (user["username"], user["name"])
+                for user in db["users"].find(
+                    {"username": {"$in": missing}}, {"username": 1, "name": 1}
+                )
+            ]
+        ),
+    )
+
+
+def group_names(group_ids: list) -> dict:
+    """Gets the names of groups, from the cache or with a single query for the missing ones
+
+    Args:
+        group_ids: A list containing ObjectIds that represent the ids of the groups
+
+    Returns:
+        A dictionary in the form of {group_id: name}
+    """
+    return group_name_cache.get_many(
+        group_ids,
+        lambda missing: dict(
+            [
+                (group["_id"], group["name"])
+                for group in db["groups"].find({"_id": {"$in": missing}}, {"name": 1})
+            ]
+        ),
+    )
+
+
+def name_posts(posts: list, authors: dict, groups: dict) -> list:
+    """Replaces the author and group ids of each post with their names
+
+    Args:
+        posts: A list containing dictionary objects that represent a post, each with the
+            fields "author_id" and "group_id"
+        authors: A dictionary in the form of {username: name}, see user_names
+        groups: A dictionary in the form of {group_id: name}, see group_names
+
+    Returns:
+        The same list, with "author_name" and "group_name" set on every post, instead of
+        "author_id" and "group_id"
+    """
+    for post in posts:
+        post["author_name"] = authors.get(post.pop("author_id"))
+        post["group_name"] = groups.get(post.pop("group_id"))
+    return posts
+
+
+def receipt_stages(username: str, changed: bool = False) -> list:
+    """Builds the aggregation stages that attach the receipt of one user to each post
+
+    Receipts are stored in the "receipts" collection, with one document per (post_id, username)
+    in the form of {post_id, username, response, date_viewed}. A receipt exists once the user has
+    viewed the post, and its response is None until the user has responded.
+
+    Args:
+        username: A string representing the username of the user
+        changed: A boolean value indicating whether to also set "changed", the later of the
+            date_modified of the post and of the receipt, for sync.get_changes. Defaults to False
+
+    Returns:
+        A list containing the aggregation stages, which set "viewed" (bool) and "acknowledged"
+        (bool or None) on each post
+    """
+    fields = {
+        "viewed": {"$gt": [{"$size": "$receipt"}, 0]},
+        "acknowledged": {"$ifNull": [{"$arrayElemAt": ["$receipt.response", 0]}, None]},
+    }
+    projection = {"_id": 0, "response": 1}
+    if changed:
+        fields["changed"] = {
+            "$max": [
+                {"$ifNull": ["$date_modified", 0]},
+                {"$ifNull": [{"$arrayElemAt": ["$receipt.date_modified", 0]}, 0]},
+            ]
+        }
+        projection["date_modified"] = 1
+    return [
+        {
+            "$lookup": {
+                "from": "receipts",
+                "localField": "_id",
+                "foreignField": "post_id",
+                "pipeline": [{"$match": {"username": username}}, {"$project": projection}],
+                "as": "receipt",
+            }
+        },
+        {"$addFields": fields},
+        {"$project": {"receipt": 0}},
+    ]
+
+
+def format_posts(posts: list) -> list:
+    """Formats posts for a user's feed
+
+    Args:
+        posts: A list containing dictionary objects that represent a post, with "viewed" and
+            "acknowledged" already set by receipt_stages
+
+    Returns:
+        A list containing the posts, with author and group names attached. All authors and
+        groups are resolved together (see user_names and group_names), so the number of
+        queries does not depend on the number of posts
+    """
+    return name_posts(
+        posts,
+        user_names([post["author_id"] for post in posts]),
+        group_names([post["group_id"] for post in posts]),
+    )
+
+
+def encode_cursor(post: dict) -> str:
+    """Encodes the position of a post in a feed as an opaque cursor
+
+    Args:
+        post: A dictionary object that represents a post, with the fields "date_created" and "_id"
+
+    Returns:
+        A string representing the cursor, which points to the posts after the given post
+    """
+    position = f"{int(post['date_created'])}:{post['_id']}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decodes a cursor made by encode_cursor
+
+    Args:
+        cursor: A string representing the cursor
+
+    Returns:
+        A tuple containing:
+            - an integer representing the date_created of the last post of the previous page
+            - an ObjectId representing the _id of the last post of the previous page
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    try:
+        date_created, post_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(date_created), ObjectId(post_id)
+    except (ValueError, UnicodeDecodeError, InvalidId) as error:
+        raise ValueError("Invalid cursor") from error
+
+
+def next_cursor(posts: list, page_size: int = PAGE_SIZE):
+    """Gets the cursor to the page after the given page of posts
+
+    Args:
+        posts: A list containing dictionary objects that represent a post, as returned by
+            helper.get_posts or helper.search_for_post
+        page_size: An integer representing the number of posts requested for the page
+
+    Returns:
+        A string representing the cursor, or None if there are no more posts to load
+    """
+    if posts and len(posts) >= clamp_page_size(page_size):
+        return encode_cursor(posts[-1])
+    return None
+
+
+def clamp_page_size(page_size: int) -> int:
+    """Limits a requested page size to between 1 and MAX_PAGE_SIZE
+
+    Args:
+        page_size: An integer representing the requested page size
+
+    Returns:
+        An integer representing the page size to use
+    """
+    return max(1, min(int(page_size), MAX_PAGE_SIZE))
+
+
+def paginate(  # pylint: disable=too-many-arguments
+    query: dict,
+    page: int,
+    cursor: str = None,
+    page_size: int = PAGE_SIZE,
+    *,
+    filters: list = None,
+    id_field: str = "_id",
+) -> list:
+    """Builds the aggregation stages that fetch a page of posts, newest first
+
+    If a cursor is given, the page starts right after the post the cursor points to, using the
+    (date_created, _id) sort key instead of skipping, so deep pages cost the same as the first
+    page. Otherwise, page is used to skip over earlier pages, for older clients.
+
+    Args:
+        query: A dictionary representing the filter on posts
+        page: An integer representing the page of posts to get
+        cursor: A string representing the cursor returned with the previous page. Defaults to None
+        page_size: An integer representing the number of posts per page. Defaults to PAGE_SIZE
+        filters: A list containing aggregation stages that further filter the sorted posts,
+            before the page is cut. Defaults to None
+        id_field: A string representing the field that holds the id of the post. Defaults to "_id"
+
+    Returns:
+        A list containing the aggregation stages
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    page_size = clamp_page_size(page_size)
+    skip = (max(page, 1) - 1) * page_size
+    if cursor:
+        date_created, post_id = decode_cursor(cursor)
+        query = dict(query)
+        query["$and"] = query.get("$and", []) + [
+            {
+                "$or": [
+                    {"date_created": {"$lt": date_created}},
+                    {"date_created": date_created, id_field: {"$lt": post_id}},
+                ]
+            }
+        ]
+        skip = 0
+    return (
+        [{"$match": query}, {"$sort": {"date_created": -1, id_field: -1}}]
+        + (filters or [])
+        + [{"$skip": skip}, {"$limit": page_size}]
+    )
+
+
+def feed_params(args) -> tuple:
+    """Reads the parameters of a request for the home feed (/api/posts/home)
+
+    Args:
+        args: A dictionary-like object of the query string, such as request.args
+
+    Returns:
+        A tuple in the form of (username, page, todo, cursor, page_size), see helper.get_posts
+
+    Raises:
+        ValueError: A parameter is missing or not an integer. The message is the response to give
+    """
+    cursor = args.get("cursor")
+    try:
+        page = int(args.get("page", 1 if cursor else None))
+        todo = bool(int(args.get("todo")))
+        page_size = int(args.get("page_size", PAGE_SIZE))
+    except (ValueError, TypeError) as error:
+        raise ValueError("Why are you even trying?") from error
+    username = args.get("username")
+    if not (username and page):
+        raise ValueError("Please provide all of the arguments required.")
+    return username, page, todo, cursor, page_size
+
+
+def feed_page(posts: list, page_size: int = PAGE_SIZE) -> dict:
+    """Builds the response of the home feed (/api/posts/home) for a page of posts
+
+    Args:
+        posts: A list containing the page of posts, from helper.get_posts
+        page_size: An integer representing the number of posts per page. Defaults to PAGE_SIZE
+
+    Returns:
+        A dictionary in the form of {"data": posts, "cursor": cursor}, see next_cursor
+    """
+    return {"data": posts, "cursor": next_cursor(posts, page_size)}
+
+
+def feed_stages(  # pylint: disable=too-many-arguments
+    username: str,
+    group_ids: list,
+    page: int,
+    todo: int,
+    *,
+    cursor: str = None,
+    page_size: int = PAGE_SIZE,
+) -> list:
+    """Builds the aggregation stages of helper.get_posts, on the posts collection
+
+    Args:
+        username: A string representing the username of the user
+        group_ids: A list containing ObjectIds that represent the ids of the user's groups
+        page, todo, cursor, page_size: See helper.get_posts
+
+    Returns:
+        A list containing the aggregation stages
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    query = {
+        "group_id": {"$in": group_ids},
+    }
+
+    if todo:
+        stages = paginate(
+            query,
+            page,
+            cursor,
+            page_size,
+            filters=receipt_stages(username)
+            + [
+                {
+                    "$match": {
+                        "$or": [
+                            {"viewed": False},  # Posts that are not viewed
+                            {  # Posts that have been viewed but not responded to
+                                "requires_acknowledgement": True,
+                                "acknowledged": None,
+                            },
+                        ]
+                    }
+                }
+            ],
+        )
+    else:
+        stages = paginate(query, page, cursor, page_size) + receipt_stages(username)
+    return stages
@@ -0,0 +1,28 @@
+"""Gunicorn configuration
+
+Loaded automatically by gunicorn when it is started from this directory (see Procfile).
+"""
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Deletes the metrics snapshots of workers from a previous run"""
+    import metrics  # pylint: disable=import-outside-toplevel
+
+    metrics.clear_snapshots()
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Flushes buffered writes and writes a last metrics snapshot before a worker exits"""
+    import receipts  # pylint: disable=import-outside-toplevel
+    import metrics  # pylint: disable=import-outside-toplevel
+
+    if receipts.receipt_buffer:
+        receipts.receipt_buffer.close()
+    metrics.write_snapshot(force=True)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Archives the counters and histograms of a worker that exited, and drops its gauges"""
+    import metrics  # pylint: disable=import-outside-toplevel
+
+    metrics.archive_snapshot(worker.pid)
@@ -0,0 +1,281 @@
+# pylint: disable=consider-using-dict-comprehension
+"""Per-user inbox entries of posts
+
+If the INBOX environment variable is set, every post is fanned out to an entry per member of its
+group (see fan_out_post), which holds the state of the member's receipt, and helper.get_posts
+reads the feed from the member's entries instead of from the posts of their groups.
+"""
+import os
+
+import pymongo
+
+import feed
+from database import db
+
+INBOX = bool(os.getenv("INBOX"))  # Fan out posts to per-user inbox entries (see fan_out_post)
+
+
+def inbox_stages(
+    username: str, page: int, todo: int, cursor: str = None, page_size: int = feed.PAGE_SIZE
+) -> list:
+    """Builds the aggregation stages of helper.get_inbox_posts, on the inbox collection
+
+    Args:
+        See helper.get_posts
+
+    Returns:
+        A list containing the aggregation stages
+
+    Raises:
+        ValueError: Invalid cursor
+    """
+    query = {"username": username}
+    if todo:
+        query["state"] = {"$in": ["unviewed", "pending"]}
+
+    return feed.paginate(query, page, cursor, page_size, id_field="post_id") + [
+        {
+            "$lookup": {
+                "from": "posts",
+                "localField": "post_id",
+                "foreignField": "_id",
+                "as": "post",
+            }
+        },
+        {"$unwind": "$post"},
+        {
+            "$replaceRoot": {
+                "newRoot": {
+                    "$mergeObjects": [
+                        "$post",
+                        {
+                            "viewed": {"$ne": ["$state", "unviewed"]},
+                            "acknowledged": {"$ifNull": ["$response", None]},
+                        },
+                    ]
+                }
+            }
+        },
+    ]
+
+
+def inbox_state(requires_acknowledgement: bool, viewed: bool, response) -> str:
+    """Gets the state of an inbox entry
+
+    Args:
+        requires_acknowledgement: A boolean value indicating if the post requires acknowledgement
+        viewed: A boolean value indicating if the user has viewed the post
+        response: The response of the user to the post, or None
+
+    Returns:
+        A string that is either "unviewed", "pending" (viewed, but awaiting a response) or "done"
+    """
+    if not viewed:
+        return "unviewed"
+    if requires_acknowledgement and response is None:
+        return "pending"
+    return "done"
+
+
+def fan_out_post(post: dict, usernames: list = None, new: bool = False) -> int:
+    """Writes the inbox entries of a post
+
+    Args:
+        post: A dictionary object that represents the post, with "_id", "group_id",
+            "date_created" and "requires_acknowledgement"
+        usernames: A list containing strings that represent the usernames of the users to write
+            entries for. Defaults to None, which is every owner and member of the post's group
+        new: A boolean value indicating if the post was just created, so that it has no receipts
+            or entries yet. Defaults to False
+
+    Returns:
+        An integer representing the number of entries written
+    """
+    if usernames is None:
+        group = db["groups"].find_one({"_id": post["group_id"]}, {"owners": 1, "members": 1})
+        usernames = list(set(group.get("owners", []) + group.get("members", []))) if group else []
+    return fan_out_posts([post], usernames, new)
+
+
+def fan_out_posts(posts: list, usernames: list, new: bool = False) -> int:
+    """Writes the inbox entries of posts for users
+
+    The receipts of all the posts are read at once, and the entries written with unordered bulk
+    writes of 1000, so the number of commands does not grow with the number of posts.
+
+    Args:
+        posts: A list containing dictionary objects that represent the posts, see fan_out_post
+        usernames: A list containing strings that represent the usernames of the users
+        new: See fan_out_post
+
+    Returns:
+        An integer representing the number of entries written
+    """
+    if not posts or not usernames:
+        return 0
+
+    receipts = {}  # {(post_id, username): response}
+    if not new:
+        receipts = dict(
+            [
+                ((receipt["post_id"], receipt["username"]), receipt["response"])
+                for receipt in db["receipts"].find(
+                    {
+                        "post_id": {"$in": [post["_id"] for post in posts]},
+                        "username": {"$in": usernames},
+                    },
+                    {"_id": 0, "post_id": 1, "username": 1, "response": 1},
+                )
+            ]
+        )
+
+    entries = []
+    for post in posts:
+        for username in usernames:
+            key = (post["_id"], username)
+            entries.append(
+                {
+                    "username": username,
+                    "post_id": post["_id"],
+                    "group_id": post["group_id"],
+                    "date_created": post["date_created"],
+                    "requires_acknowledgement": post["requires_acknowledgement"],
+                    "state": inbox_state(
+                        post["requires_acknowledgement"], key in receipts, receipts.get(key)
+                    ),
+                    "response": receipts.get(key),
+                }
+            )
+
+    for i in range(0, len(entries), 1000):
+        if new:
+            db["inbox"].insert_many(entries[i : i + 1000], ordered=False)
+        else:
+            db["inbox"].bulk_write(
+                [
+                    pymongo.ReplaceOne(
+                        {"username": entry["username"], "post_id": entry["post_id"]},
+                        entry,
+                        upsert=True,
+                    )
+                    for entry in entries[i : i + 1000]
+                ],
+                ordered=False,
+            )
+    return len(entries)
+
+
+def fan_out_group(group_id, usernames: list) -> int:
+    """Writes the inbox entries of every post of a group, for users added to the group
+
+    Args:
+        group_id: An ObjectId representing the id of the group
+        usernames: A list containing strings that represent the usernames of the users
+
+    Returns:
+        An integer representing the number of entries written
+    """
+    if not usernames:
+        return 0
+    posts = db["posts"].find(
+        {"group_id": group_id}, {"group_id": 1, "date_created": 1, "requires_acknowledgement": 1}
+    )
+    return fan_out_posts(list(posts), usernames)
+
+
+def update_inbox(events: dict):
+    """Applies views and responses to inbox entries
+
+    Args:
+        events: A dictionary in the form of {(post_id, username): event}, where event is a
+            dictionary that contains "response" if the user responded, and is empty otherwise
+    """
+    requests = inbox_requests(events)
+    if requests:
+        db["inbox"].bulk_write(requests, ordered=False)
+
+
+def inbox_requests(events: dict) -> list:
+    """Builds the writes that apply views and responses to inbox entries
+
+    Args:
+        events: See update_inbox
+
+    Returns:
+        A list containing pymongo.UpdateOne objects, for a bulk_write on the inbox collection
+    """
+    requests = []
+    for (post_id, username), event in events.items():
+        if "response" in event:
+            requests.append(
+                pymongo.UpdateOne(
+                    {"username": username, "post_id": post_id},
+                    {"$set": {"state": "done", "response": event["response"]}},
+                )
+            )
+        else:  # Only unviewed entries, so that a response recorded first is kept
+            requests.append(
+                pymongo.UpdateOne(
+                    {"username": username, "post_id": post_id, "state": "unviewed"},
+                    [
+                        {
+                            "$set": {
+                                "state": {
+                                    "$cond": ["$requires_acknowledgement", "pending", "done"]
+                                }
+                            }
+                        }
+                    ],
+                )
+            )
+    return requests
+
+
+def update_inbox_acknowledgement(post_id, requires_acknowledgement: bool):
+    """Changes whether the inbox entries of a post require acknowledgement, keeping their state
+
+    Args:
+        post_id: An ObjectId representing the id of the post
+        requires_acknowledgement: A boolean value indicating if the post requires acknowledgement
+    """
+    db["inbox"].update_many(
+        {"post_id": post_id},
+        [
+            {
+                "$set": {
+                    "requires_acknowledgement": requires_acknowledgement,
+                    "state": {
+                        "$cond": [
+                            {"$eq": ["$state", "unviewed"]},
+                            "unviewed",
+                            {
+                                "$cond": [
+                                    {
+                                        "$and": [
+                                            requires_acknowledgement,
+                                            {"$eq": [{"$ifNull": ["$response", None]}, None]},
+                                        ]
+                                    },
+                                    "pending",
+                                    "done",
+                                ]
+                            },
+                        ]
+                    },
+                }
+            }
+        ],
+    )
+
+
+def backfill_inbox() -> int:
+    """Writes the inbox entries of every post, for enabling INBOX on an existing database
+
+    Returns:
+        An integer representing the number of entries written
+    """
+    written = 0
+    posts = db["posts"].find({}, {"group_id": 1, "date_created": 1, "requires_acknowledgement": 1})
+    for post in posts:
+        written += fan_out_post(post)
+    return written
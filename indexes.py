@@ -0,0 +1,295 @@
+"""Index management for helper.py
+
+This module creates the indexes that the queries of helper.py (and of the modules it uses, such as
+feed.py and sync.py) depend on, and checks the query
+plans of those queries. It can be run at startup (see app.py) or from the command line:
+
+    python indexes.py           # create missing indexes
+    python indexes.py --verify  # create missing indexes, then check the query plans
+"""
+import datetime
+import sys
+from functools import partial
+
+import pymongo
+from bson import ObjectId
+
+import feed
+import helper
+import inbox
+import sync
+
+# {collection: [(keys, options)]}
+INDEXES = {
+    "posts": [
+        (
+            [
+                ("group_id", pymongo.ASCENDING),
+                ("date_created", pymongo.DESCENDING),
+                ("_id", pymongo.DESCENDING),
+            ],
+            {"name": "group_id_date_created"},
+        ),
+        (
+            [("group_id", pymongo.ASCENDING), ("date_modified", pymongo.ASCENDING)],
+            {"name": "group_id_date_modified"},
+        ),
+        ([("date_modified", pymongo.ASCENDING)], {"name": "date_modified"}),  # broker.py polls
+        ([("title", pymongo.TEXT), ("body", pymongo.TEXT)], {"name": "posts_text"}),
+    ],
+    "groups": [
+        ([("owners", pymongo.ASCENDING)], {"name": "owners"}),
+        ([("members", pymongo.ASCENDING)], {"name": "members"}),
+    ],
+    "users": [
+        ([("username", pymongo.ASCENDING)], {"name": "username", "unique": True}),
+        ([("push_token", pymongo.ASCENDING)], {"name": "push_token", "sparse": True}),
+    ],
+    "receipts": [
+        (
+            [("post_id", pymongo.ASCENDING), ("username", pymongo.ASCENDING)],
+            {"name": "post_id_username", "unique": True},
+        ),
+        (
+            [("username", pymongo.ASCENDING), ("date_modified", pymongo.ASCENDING)],
+            {"name": "username_date_modified"},
+        ),
+    ],
+    "inbox": [
+        (
+            [
+                ("username", pymongo.ASCENDING),
+                ("date_created", pymongo.DESCENDING),
+                ("post_id", pymongo.DESCENDING),
+            ],
+            {"name": "username_date_created"},
+        ),
+        (
+            [
+                ("username", pymongo.ASCENDING),
+                ("state", pymongo.ASCENDING),
+                ("date_created", pymongo.DESCENDING),
+                ("post_id", pymongo.DESCENDING),
+            ],
+            {"name": "username_state_date_created"},
+        ),
+        (
+            [("post_id", pymongo.ASCENDING), ("username", pymongo.ASCENDING)],
+            {"name": "post_id_username", "unique": True},
+        ),
+        (
+            [("group_id", pymongo.ASCENDING), ("username", pymongo.ASCENDING)],
+            {"name": "group_id_username"},
+        ),
+    ],
+    "deletions": [
+        (
+            [("group_id", pymongo.ASCENDING), ("date_deleted", pymongo.ASCENDING)],
+            {"name": "group_id_date_deleted"},
+        ),
+        (
+            [("usernames", pymongo.ASCENDING), ("date_deleted", pymongo.ASCENDING)],
+            {"name": "usernames_date_deleted"},
+        ),
+        (  # TTL indexes only expire dates, so this is not on the date_deleted timestamp
+            [("deleted_at", pymongo.ASCENDING)],
+            {"name": "deleted_at_ttl", "expireAfterSeconds": sync.DELETIONS_TTL},
+        ),
+    ],
+    "memberships": [
+        (
+            [("usernames", pymongo.ASCENDING), ("date_added", pymongo.ASCENDING)],
+            {"name": "usernames_date_added"},
+        ),
+        (  # Kept as long as deletions, since sync tokens older than that are refused
+            [("added_at", pymongo.ASCENDING)],
+            {"name": "added_at_ttl", "expireAfterSeconds": sync.DELETIONS_TTL},
+        ),
+    ],
+}
+
+
+def ensure_indexes(database) -> dict:
+    """Creates the indexes in INDEXES that do not exist yet
+
+    Creating an index that already exists with the same keys and options does nothing, so this
+    can be run any number of times.
+
+    Args:
+        database: A pymongo.database.Database object to create the indexes in
+
+    Returns:
+        A dictionary in the form of {index_name: error}, containing the indexes that could not be
+        created (for example, because an index with different options already exists)
+    """
+    errors = {}
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                database[collection].create_index(keys, **options)
+            except pymongo.errors.OperationFailure as error:
+                errors[options["name"]] = str(error)
+    return errors
+
+
+def explain_aggregate(database, collection: str, stages: list):
+    """Gets a function that explains an aggregation, like Cursor.explain for a query
+
+    Args:
+        database: A pymongo.database.Database object to explain the aggregation on
+        collection: A string representing the name of the collection to aggregate
+        stages: A list containing the aggregation stages
+
+    Returns:
+        A function that takes no arguments and returns the explain output of the aggregation
+    """
+    command = database[collection].database.command  # database may be a database.LazyDatabase
+    return partial(command, "aggregate", collection, pipeline=stages, explain=True)
+
+
+def hot_queries(database) -> dict:
+    """Gets the queries that helper.py runs on every request, and the polls of broker.py
+
+    The aggregations and filters are built by the same functions as in helper.py, so that the
+    plans checked are those of the queries that the app actually runs.
+
+    Args:
+        database: A pymongo.database.Database object to run the queries on
+
+    Returns:
+        A dictionary in the form of {description: (explain, allow_sort)}, where explain is a
+        function that returns the explain output of the query, and allow_sort indicates whether an
+        in-memory sort is expected (text search results and sync changes cannot be sorted by an
+        index)
+    """
+    username, group_ids = "username", [ObjectId(), ObjectId()]
+    return {
+        "home feed": (
+            explain_aggregate(database, "posts", feed.feed_stages(username, group_ids, 1, 0)),
+            False,
+        ),
+        "home feed todo": (
+            explain_aggregate(database, "posts", feed.feed_stages(username, group_ids, 1, 1)),
+            False,
+        ),
+        "inbox": (
+            explain_aggregate(database, "inbox", inbox.inbox_stages(username, 1, 0)),
+            False,
+        ),
+        "inbox todo": (
+            explain_aggregate(database, "inbox", inbox.inbox_stages(username, 1, 1)),
+            False,
+        ),
+        "post search": (
+            explain_aggregate(database, "posts", helper.search_stages("test", group_ids)),
+            True,
+        ),
+        "post search by relevance": (
+            explain_aggregate(
+                database, "posts", helper.search_stages("test", group_ids, "relevance")
+            ),
+            True,
+        ),
+        "sync": (
+            explain_aggregate(database, "posts", sync.sync_stages(username, group_ids, 0)),
+            True,
+        ),
+        "sync tombstones": (
+            database["deletions"].find(sync.tombstone_filter(username, group_ids, 0)).explain,
+            False,
+        ),
+        "groups with user": (
+            database["groups"].find(feed.membership_filter(username)).explain,
+            False,
+        ),
+        "user by username": (
+            database["users"].find({"username": username}).limit(1).explain,
+            False,
+        ),
+        "receipt of user": (
+            database["receipts"].find({"post_id": ObjectId(), "username": username}).explain,
+            False,
+        ),
+        "receipts of post": (database["receipts"].find({"post_id": ObjectId()}).explain, False),
+        "posts modified since (polls)": (
+            database["posts"].find({"date_modified": {"$gt": 0}}).explain,
+            False,
+        ),
+        "deletions since (polls)": (
+            database["deletions"]
+            .find({"deleted_at": {"$gt": datetime.datetime(2020, 1, 1)}})
+            .explain,
+            False,
+        ),
+    }
+
+
+def winning_plans(explained) -> list:
+    """Finds the winning plans in explain output, such as those of the stages of an aggregation
+
+    Args:
+        explained: A dictionary representing explain output, or a part of it
+
+    Returns:
+        A list containing dictionaries that represent the winning plans
+    """
+    if isinstance(explained, dict):
+        if "winningPlan" in explained:  # Not the rejected plans next to it
+            return [explained["winningPlan"]]
+        values = explained.values()
+    elif isinstance(explained, list):
+        values = explained
+    else:
+        return []
+    return [plan for value in values for plan in winning_plans(value)]
+
+
+def plan_stages(plan: dict) -> list:
+    """Lists the stages of a query plan
+
+    Args:
+        plan: A dictionary representing a query plan, from explain()
+
+    Returns:
+        A list containing strings that represent the names of every stage in the plan
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+def verify_query_plans(database) -> dict:
+    """Checks that none of the hot queries fall back to a collection scan or an in-memory sort
+
+    Args:
+        database: A pymongo.database.Database object to explain the queries on
+
+    Returns:
+        A dictionary in the form of {description: [bad_stages]}, containing only the queries with
+        bad plans. An empty dictionary means that all plans are good.
+    """
+    problems = {}
+    for description, (explain, allow_sort) in hot_queries(database).items():
+        stages = [stage for plan in winning_plans(explain()) for stage in plan_stages(plan)]
+        bad_stages = [
+            stage for stage in stages if stage == "COLLSCAN" or (stage == "SORT" and not allow_sort)
+        ]
+        if bad_stages:
+            problems[description] = bad_stages
+    return problems
+
+
+if __name__ == "__main__":
+    from database import db
+
+    for name, message in ensure_indexes(db).items():
+        print(f"Could not create index {name}: {message}")
+    if "--verify" in sys.argv:
+        plan_problems = verify_query_plans(db)
+        for query, bad in plan_problems.items():
+            print(f"{query}: {', '.join(bad)}")
+        sys.exit(1 if plan_problems else 0)
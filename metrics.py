@@ -0,0 +1,432 @@
+"""Metrics for app.py and asyncapi.py
+
+This module collects request latencies (see record_request), MongoDB command latencies (through a
+pymongo CommandListener, registered for every client created after this module is imported) and
+the number of MongoDB commands per request, and renders them in the Prometheus text format.
+
+Every gunicorn worker collects its own metrics. If the METRICS_DIR environment variable is set,
+each worker also writes a snapshot of its metrics to that directory, at most every
+METRICS_INTERVAL seconds, and render_all merges the snapshots of all workers, so that a scrape
+of /metrics reports the whole server whichever worker answers it. Counters and histograms are
+summed across workers, and so are gauges (such as the number of buffered writes). When a worker
+exits, its counters and histograms are added to an archive snapshot and its own snapshot is
+deleted (see gunicorn.conf.py), so that counters never go backwards while a scrape only reports
+the gauges of live workers.
+
+If the SLOW_QUERY_MS environment variable is set, every MongoDB command that takes longer than
+that many milliseconds is also logged to the "slow_queries" logger, with its filter, sort or
+pipeline and the route of the request that ran it.
+"""
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from itertools import accumulate
+from time import monotonic, perf_counter
+
+from bson.json_util import dumps
+from pymongo import monitoring
+
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "5"))
+ARCHIVE_FILE = "archive.json"  # Counters and histograms of the workers that exited
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))  # 0 disables the slow-query log
+SLOW_QUERY_FIELDS = ("filter", "sort", "pipeline", "updates", "deletes", "query")
+
+slow_query_logger = logging.getLogger("slow_queries")
+last_write = 0.0  # pylint: disable=invalid-name
+
+# {name: (help, buckets)}
+HISTOGRAMS = {
+    "http_request_duration_seconds": (
+        "Time taken to handle HTTP requests",
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    ),
+    "http_request_mongo_commands": (
+        "Number of MongoDB commands run by HTTP requests",
+        (0, 1, 2, 3, 5, 10, 20, 50, 100),
+    ),
+    "mongo_command_duration_seconds": (
+        "Time taken by MongoDB commands",
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+    ),
+}
+# {name: help}
+COUNTERS = {"mongo_command_failures_total": "Number of MongoDB commands that failed"}
+
+
+class Registry:
+    """Holds the metrics of the current process
+
+    Metrics are identified by their name and their labels, which are given as a dictionary. Label
+    values are converted to strings.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(name, labels): [counts of the values in each bucket but not the previous one..., sum,
+        # count]}, which snapshot makes cumulative
+        self._histograms = {}
+        self._counters = {}  # {(name, labels): value}
+        self._collectors = []
+
+    def observe(self, name: str, labels: dict, value: float):
+        """Records a value in a histogram
+
+        Args:
+            name: A string representing the name of the histogram, in HISTOGRAMS
+            labels: A dictionary in the form of {label: value}
+            value: A float representing the value
+        """
+        buckets = HISTOGRAMS[name][1]
+        key = (name, label_key(labels))
+        with self._lock:
+            counts = self._histograms.setdefault(key, [0] * len(buckets) + [0.0, 0])
+            if (i := bisect_left(buckets, value)) < len(buckets):
+                counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def inc(self, name: str, labels: dict, value: float = 1):
+        """Increments a counter
+
+        Args:
+            name: A string representing the name of the counter, in COUNTERS
+            labels: A dictionary in the form of {label: value}
+            value: A float representing the increment. Defaults to 1
+        """
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_collector(self, collector):
+        """Registers a function that reports gauges whenever a snapshot is taken
+
+        Args:
+            collector: A function that returns a list containing tuples in the form of
+                (name, help, labels, value), where labels is a dictionary
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        """Takes a snapshot of the metrics
+
+        Returns:
+            A JSON-serialisable dictionary in the form of {"histograms": [...], "counters": [...],
+            "gauges": [...]}, which can be merged with merge and rendered with render
+        """
+        gauges = []
+        for collector in self._collectors:
+            gauges += [
+                [name, help_, label_key(labels), value]
+                for name, help_, labels, value in collector()
+            ]
+        with self._lock:
+            return {
+                "histograms": [
+                    [name, labels, list(accumulate(counts[:-2])) + counts[-2:]]
+                    for (name, labels), counts in self._histograms.items()
+                ],
+                "counters": [
+                    [name, labels, value] for (name, labels), value in self._counters.items()
+                ],
+                "gauges": gauges,
+            }
+
+
+def label_key(labels: dict) -> tuple:
+    """Converts labels to a hashable, ordered form
+
+    Args:
+        labels: A dictionary in the form of {label: value}
+
+    Returns:
+        A tuple containing tuples in the form of (label, value), sorted by label
+    """
+    return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def merge(snapshots: list) -> dict:
+    """Sums snapshots of metrics, such as those of different workers
+
+    Args:
+        snapshots: A list containing dictionaries that represent snapshots, from Registry.snapshot
+
+    Returns:
+        A dictionary in the form of {"histograms": {(name, labels): counts}, "counters":
+        {(name, labels): value}, "gauges": {(name, labels): value}, "help": {name: help}}
+    """
+    merged = {"histograms": {}, "counters": {}, "gauges": {}, "help": {}}
+    for snapshot in snapshots:
+        for name, labels, counts in snapshot["histograms"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            totals = merged["histograms"].setdefault(key, [0] * len(counts))
+            merged["histograms"][key] = [total + count for total, count in zip(totals, counts)]
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged["counters"][key] = merged["counters"].get(key, 0) + value
+        for name, help_, labels, value in snapshot["gauges"]:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged["gauges"][key] = merged["gauges"].get(key, 0) + value
+            merged["help"][name] = help_
+    return merged
+
+
+def format_labels(labels: tuple, **extra) -> str:
+    """Formats labels for the Prometheus text format
+
+    Args:
+        labels: A tuple containing tuples in the form of (label, value)
+        extra: Further labels, such as "le" for histogram buckets
+
+    Returns:
+        A string in the form of '{label="value",...}', or an empty string if there are no labels
+    """
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = [
+        (label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in pairs
+    ]
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+def render(merged: dict) -> str:
+    """Renders merged metrics in the Prometheus text format
+
+    Args:
+        merged: A dictionary representing metrics, from merge
+
+    Returns:
+        A string representing the metrics
+    """
+    lines = []
+    for name, (help_, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} histogram"]
+        for (name_, labels), counts in sorted(merged["histograms"].items()):
+            if name_ != name:
+                continue
+            for bucket, count in zip(buckets, counts):
+                lines.append(f"{name}_bucket{format_labels(labels, le=bucket)} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {counts[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {counts[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {counts[-1]}")
+    for name, help_ in COUNTERS.items():
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} counter"]
+        for (name_, labels), value in sorted(merged["counters"].items()):
+            if name_ == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, help_ in sorted(merged["help"].items()):
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} gauge"]
+        for (name_, labels), value in sorted(merged["gauges"].items()):
+            if name_ == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(force: bool = False):
+    """Writes a snapshot of the metrics of this process to METRICS_DIR
+
+    Does nothing if METRICS_DIR is not set, or if the last snapshot was written less than
+    METRICS_INTERVAL seconds ago (unless force is True).
+
+    Args:
+        force: A boolean value indicating whether to write even if a snapshot was written recently.
+            Defaults to False
+    """
+    global last_write  # pylint: disable=global-statement,invalid-name
+    if not METRICS_DIR or (not force and monotonic() - last_write < METRICS_INTERVAL):
+        return
+    last_write = monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(registry.snapshot(), file)
+    os.replace(f"{path}.tmp", path)  # Readers never see a partly written snapshot
+
+
+def render_all() -> str:
+    """Renders the metrics of all workers, or of this process if METRICS_DIR is not set
+
+    Returns:
+        A string representing the metrics in the Prometheus text format
+    """
+    if not METRICS_DIR:
+        return render(merge([registry.snapshot()]))
+    write_snapshot(force=True)
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path, encoding="utf-8") as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            pass
+    return render(merge(snapshots))
+
+
+def archive_snapshot(pid: int):
+    """Adds the counters and histograms of a process that exited to the archive in METRICS_DIR,
+    and deletes its snapshot, with its gauges
+
+    Args:
+        pid: An integer representing the process id of the process
+    """
+    if not METRICS_DIR:
+        return
+    archive = os.path.join(METRICS_DIR, ARCHIVE_FILE)
+    snapshots = []
+    for path in (archive, os.path.join(METRICS_DIR, f"{pid}.json")):
+        try:
+            with open(path, encoding="utf-8") as file:
+                snapshots.append(dict(json.load(file), gauges=[]))
+        except (OSError, ValueError):
+            pass
+    merged = merge(snapshots)
+    with open(f"{archive}.tmp", "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "histograms": [
+                    [name, labels, counts]
+                    for (name, labels), counts in merged["histograms"].items()
+                ],
+                "counters": [
+                    [name, labels, value] for (name, labels), value in merged["counters"].items()
+                ],
+                "gauges": [],
+            },
+            file,
+        )
+    os.replace(f"{archive}.tmp", archive)
+    remove_snapshot(pid)
+
+
+def remove_snapshot(pid: int):
+    """Deletes the snapshot of a process in METRICS_DIR, such as a worker that exited
+
+    Args:
+        pid: An integer representing the process id of the process
+    """
+    if METRICS_DIR:
+        try:
+            os.remove(os.path.join(METRICS_DIR, f"{pid}.json"))
+        except FileNotFoundError:
+            pass
+
+
+def clear_snapshots():
+    """Deletes the snapshots in METRICS_DIR, and the archive, such as those left by a previous
+    run"""
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            os.remove(path)
+
+
+def begin_request(route: str = ""):
+    """Starts counting the MongoDB commands run by the current request
+
+    The request is held in a context variable, so that commands are counted for the thread of a
+    Flask request, and for the task of a Quart request, including the commands that motor runs
+    in its thread pool (motor copies the context to it).
+
+    Args:
+        route: A string representing the route of the request, for the slow-query log. Defaults
+            to an empty string
+    """
+    current_request.set({"commands": 0, "route": route, "started": perf_counter()})
+
+
+def end_request() -> int:
+    """Stops counting the MongoDB commands run by the current request
+
+    Returns:
+        An integer representing the number of commands run since begin_request
+    """
+    started = current_request.get()
+    current_request.set(None)
+    return started["commands"] if started else 0
+
+
+def record_request(method: str, status: int):
+    """Records the latency and the number of MongoDB commands of the request started by
+    begin_request, and ends it
+
+    Args:
+        method: A string representing the HTTP method of the request
+        status: An integer representing the status code of the response
+    """
+    started = current_request.get() or {"route": "unmatched", "started": perf_counter()}
+    route = started["route"]
+    registry.observe(
+        "http_request_duration_seconds",
+        {"route": route, "method": method, "status": status},
+        perf_counter() - started["started"],
+    )
+    registry.observe("http_request_mongo_commands", {"route": route}, end_request())
+    write_snapshot()
+
+
+def log_slow_query(labels: dict, command: dict, duration: float, route: str):
+    """Logs a MongoDB command that took longer than SLOW_QUERY_MS
+
+    Args:
+        labels: A dictionary containing "command" and "collection"
+        command: A dictionary representing the command document
+        duration: A float representing the number of seconds the command took
+        route: A string representing the route of the request that ran the command
+    """
+    details = {field: command[field] for field in SLOW_QUERY_FIELDS if field in command}
+    slow_query_logger.warning(
+        dumps(dict(labels, route=route, duration_ms=round(duration * 1000, 1), **details))[:4000]
+    )
+
+
+class CommandListener(monitoring.CommandListener):
+    """Records the latency, failures and count of MongoDB commands"""
+
+    def __init__(self):
+        self._started = {}  # {(connection_id, request_id): (labels, command, route)}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        labels = {
+            "command": event.command_name,
+            "collection": collection if isinstance(collection, str) else "",
+        }
+        request = current_request.get()
+        # The command document is only kept when it may have to be logged
+        self._started[(event.connection_id, event.request_id)] = (
+            labels,
+            event.command if SLOW_QUERY_MS else None,
+            request["route"] if request else "",
+        )
+        if request:
+            request["commands"] += 1
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        if started := self._finished(event):
+            registry.inc("mongo_command_failures_total", started[0])
+
+    def _finished(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started:
+            labels, command, route = started
+            duration = event.duration_micros / 1e6
+            registry.observe("mongo_command_duration_seconds", labels, duration)
+            if SLOW_QUERY_MS and duration * 1000 > SLOW_QUERY_MS:
+                log_slow_query(labels, command, duration, route)
+        return started
+
+
+registry = Registry()
+# {"commands": int, "route": str, "started": float} of the current request, see begin_request
+current_request = contextvars.ContextVar("current_request", default=None)
+monitoring.register(CommandListener())
@@ -0,0 +1,86 @@
+"""Data migrations for helper.py
+
+This module moves data written by older versions of helper.py into its current layout. Every
+migration can be run more than once. Run all of them from the command line with:
+
+    python migrations.py          # migrate data
+    python migrations.py --inbox  # migrate data, then write the inbox entries of every post
+    python migrations.py --badges # migrate data, then recount the to-do counters of every user
+"""
+import sys
+
+import pymongo
+
+BATCH_SIZE = 1000  # Number of writes sent per bulk_write
+
+
+def migrate_receipts(database) -> int:
+    """Moves the "viewed" and "acknowledged" arrays of posts into the receipts collection
+
+    Args:
+        database: A pymongo.database.Database object to migrate
+
+    Returns:
+        An integer representing the number of posts migrated
+    """
+    migrated = 0
+    posts = database["posts"].find(
+        {"$or": [{"viewed": {"$exists": True}}, {"acknowledged": {"$exists": True}}]},
+        {"viewed": 1, "acknowledged": 1},
+    )
+    for post in posts:
+        responses = dict.fromkeys(post.get("viewed", []))
+        for entry in post.get("acknowledged", []):
+            responses[entry["username"]] = entry["response"]
+
+        requests = [
+            pymongo.UpdateOne(
+                {"post_id": post["_id"], "username": username},
+                {"$setOnInsert": {"response": response, "date_viewed": None}},
+                upsert=True,
+            )
+            for username, response in responses.items()
+        ]
+        for i in range(0, len(requests), BATCH_SIZE):
+            database["receipts"].bulk_write(requests[i : i + BATCH_SIZE], ordered=False)
+
+        database["posts"].update_one(
+            {"_id": post["_id"]}, {"$unset": {"viewed": "", "acknowledged": ""}}
+        )
+        migrated += 1
+    return migrated
+
+
+def migrate_date_modified(database) -> int:
+    """Sets "date_modified" (in milliseconds) on posts and receipts that do not have it
+
+    Posts get the time they were created, and receipts the time they were viewed, or 0 if that
+    is unknown.
+
+    Args:
+        database: A pymongo.database.Database object to migrate
+
+    Returns:
+        An integer representing the number of documents migrated
+    """
+    migrated = 0
+    for collection, field in (("posts", "date_created"), ("receipts", "date_viewed")):
+        update = database[collection].update_many(
+            {"date_modified": {"$exists": False}},
+            [{"$set": {"date_modified": {"$multiply": [{"$ifNull": [f"${field}", 0]}, 1000]}}}],
+        )
+        migrated += update.modified_count
+    return migrated
+
+
+if __name__ == "__main__":
+    import badges
+    import helper
+    import inbox
+
+    print(f"Migrated receipts of {migrate_receipts(helper.db)} post(s)")
+    print(f"Set date_modified on {migrate_date_modified(helper.db)} document(s)")
+    if "--inbox" in sys.argv:
+        print(f"Wrote {inbox.backfill_inbox()} inbox entries")
+    if "--badges" in sys.argv:
+        print(f"Recounted the badges of {badges.reconcile_badges()} user(s)")
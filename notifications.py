@@ -1,34 +1,179 @@
 """Notifications functions for app.py
 
-This module provides notifications for the mobile app.
+This module provides notifications for the mobile app. Notifications are sent to Expo's push
+API in chunks, over a pooled HTTP session, from a background thread pool, so that the request
+that triggered them does not wait. Tasks that fail are logged to the "notifications" logger. The
+Expo URLs can be changed with the EXPO_PUSH_URL and EXPO_RECEIPTS_URL environment variables (for
+example, to point them at a local stub server).
 """
 import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
 import requests
+from requests.adapters import HTTPAdapter
+
+PUSH_URL = os.getenv("EXPO_PUSH_URL", "https://exp.host/--/api/v2/push/send")
+RECEIPTS_URL = os.getenv("EXPO_RECEIPTS_URL", "https://exp.host/--/api/v2/push/getReceipts")
+CHUNK_SIZE = 100  # Largest number of messages Expo accepts per request
+RETRIES = 3  # Number of retries of a chunk, after the first attempt
+BACKOFF = 1.0  # Seconds to wait before the first retry, doubled for every retry after that
+RECEIPT_DELAY = float(os.getenv("EXPO_RECEIPT_DELAY", "15"))  # Seconds before fetching receipts
+
+HEADERS = {
+    "accept": "application/json",
+    "accept-encoding": "gzip, deflate",
+    "content-type": "application/json",
+}
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="notifications")
+logger = logging.getLogger(__name__)
+
+
+def post_json(url: str, payload) -> dict:
+    """Posts JSON to Expo, retrying with exponential backoff
+
+    Args:
+        url: A string representing the URL to post to
+        payload: The JSON-serialisable payload
+
+    Returns:
+        A dictionary representing the JSON response, or an empty dictionary if all attempts failed
+    """
+    for attempt in range(RETRIES + 1):
+        try:
+            response = session.post(url, data=json.dumps(payload), headers=HEADERS, timeout=10)
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code != 429 and response.status_code < 500:
+                return {}
+        except (requests.RequestException, ValueError):
+            pass
+        if attempt < RETRIES:
+            sleep(BACKOFF * 2 ** attempt)
+    return {}
 
 
-def notify(push_tokens: list, title: str, body: str):
+def dead_tokens(messages: list, results: list) -> list:
+    """Finds the push tokens that Expo reported as no longer registered
+
+    Args:
+        messages: A list containing dictionaries that represent the messages sent, in order
+        results: A list containing dictionaries that represent Expo's tickets or receipts, in the
+            same order as messages
+
+    Returns:
+        A list containing strings that represent the dead push tokens
+    """
+    return [
+        message["to"]
+        for message, result in zip(messages, results)
+        if result.get("status") == "error"
+        and result.get("details", {}).get("error") == "DeviceNotRegistered"
+    ]
+
+
+def notify(push_tokens: list, title: str, body: str, on_dead_tokens=None) -> bool:
     """Sends push notifications to specified users' devices
 
     Args:
         push_tokens: List of users' Expo push tokens
         title: Title of notification
         body: Body of notification
+        on_dead_tokens: A function that is called with a list of push tokens that are no longer
+            registered, so they can be removed. Defaults to None
 
     Returns:
         Whether operation is successful
     """
-    request = requests.post(
-        "https://exp.host/--/api/v2/push/send",
-        data=json.dumps({"to": push_tokens, "title": title, "body": body,}),
-        headers={
-            "host": "exp.host",
-            "accept": "application/json",
-            "accept-encoding": "gzip, deflate",
-            "content-type": "application/json",
-        },
-    )
-    print(request.text)
-    return request.status_code == 200
+    success = True
+    dead = []
+    ticket_ids = {}  # {ticket_id: message}
+    for i in range(0, len(push_tokens), CHUNK_SIZE):
+        messages = [
+            {"to": push_token, "title": title, "body": body}
+            for push_token in push_tokens[i : i + CHUNK_SIZE]
+        ]
+        tickets = post_json(PUSH_URL, messages).get("data")
+        if not isinstance(tickets, list):
+            success = False
+            continue
+        dead += dead_tokens(messages, tickets)
+        for message, ticket in zip(messages, tickets):
+            if ticket.get("status") == "ok" and "id" in ticket:
+                ticket_ids[ticket["id"]] = message
+
+    if dead and on_dead_tokens:
+        on_dead_tokens(dead)
+    if ticket_ids and on_dead_tokens:
+        # Receipts are only available some time after sending
+        timer = threading.Timer(RECEIPT_DELAY, check_receipts, (ticket_ids, on_dead_tokens))
+        timer.daemon = True
+        timer.start()
+    return success
+
+
+def check_receipts(ticket_ids: dict, on_dead_tokens):
+    """Fetches the receipts of sent notifications, and reports the push tokens that are dead
+
+    Args:
+        ticket_ids: A dictionary in the form of {ticket_id: message}
+        on_dead_tokens: A function that is called with a list of push tokens that are no longer
+            registered
+    """
+    dead = []
+    ids = list(ticket_ids)
+    for i in range(0, len(ids), CHUNK_SIZE * 10):  # Expo accepts 1000 ids per request
+        receipts = post_json(RECEIPTS_URL, {"ids": ids[i : i + CHUNK_SIZE * 10]}).get("data")
+        if isinstance(receipts, dict):
+            known = [ticket_id for ticket_id in receipts if ticket_id in ticket_ids]
+            dead += dead_tokens(
+                [ticket_ids[ticket_id] for ticket_id in known],
+                [receipts[ticket_id] for ticket_id in known],
+            )
+    if dead:
+        on_dead_tokens(dead)
+
+
+def dispatch(get_push_tokens, title: str, body: str, on_dead_tokens=None):
+    """Sends push notifications in the background
+
+    Args:
+        get_push_tokens: A function that returns the list of push tokens to notify. It is called
+            in the background, so that looking up the tokens does not block the caller either
+        title: Title of notification
+        body: Body of notification
+        on_dead_tokens: See notify. Defaults to None
+
+    Returns:
+        A concurrent.futures.Future object that resolves to the return value of notify
+    """
+
+    def task():
+        push_tokens = get_push_tokens()
+        if not push_tokens:
+            return True
+        return notify(push_tokens, title, body, on_dead_tokens)
+
+    future = executor.submit(task)
+    future.add_done_callback(log_failure)
+    return future
+
+
+def log_failure(future):
+    """Logs the exception of a notification task, if it raised one
+
+    Args:
+        future: A concurrent.futures.Future object of a finished task, from dispatch
+    """
+    if not future.cancelled() and (error := future.exception()) is not None:
+        logger.error("Sending notifications failed", exc_info=error)
 
 
 if __name__ == "__main__":
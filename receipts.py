@@ -0,0 +1,431 @@
+# pylint: disable=consider-using-dict-comprehension
+"""Views and responses of posts
+
+Every view or response is stored in the receipts collection, as one document per post and user,
+and updates the data derived from receipts: the version stamp of the user (see versions.py), and,
+if enabled, the user's inbox entries (see inbox.py) and to-do counters (see badges.py). If the
+WRITE_BEHIND environment variable is set, views and responses are buffered and written in batches
+(see writebehind.py).
+"""
+import os
+from time import time
+
+import pymongo
+from bson import ObjectId
+
+import badges
+import inbox
+import versions
+from database import db
+from writebehind import WriteBehindBuffer
+
+BATCH_LIMIT = 1000  # Largest number of operations accepted by apply_receipts
+
+# Opt-in write-behind buffering of views and responses (see writebehind.py)
+receipt_buffer = (
+    WriteBehindBuffer(
+        db,
+        int(os.getenv("WRITE_BEHIND_SIZE", "500")),
+        float(os.getenv("WRITE_BEHIND_INTERVAL", "1")),
+        lambda events: receipts_flushed(events),  # pylint: disable=unnecessary-lambda
+        read_before=badges.BADGES,
+    )
+    if os.getenv("WRITE_BEHIND")
+    else None
+)
+
+
+def view_post(username: str, post_id: str) -> bool:
+    """Sets the status of a post to read
+
+    Args:
+        username: A string representing the username of the user
+        post_id: A string representing the post id of the post to be set to viewed
+
+    Returns:
+        A boolean value indicating if setting the post to viewed was successful, which is False
+        if the post does not exist. If write-behind buffering is enabled, the view is only
+        queued, and True is returned
+    """
+    post = db["posts"].find_one({"_id": ObjectId(post_id)}, {"requires_acknowledgement": 1})
+    if post is None:  # Receipts are never written for deleted or unknown posts
+        return False
+    if receipt_buffer:
+        receipt_buffer.view(username, post["_id"], view_pending(post))
+        return True
+    update = db["receipts"].update_one(**view_upsert(username, post))
+    if update.upserted_id is not None:
+        write_all(view_writes(username, post))
+    return update.upserted_id is not None
+
+
+def view_upsert(username: str, post: dict) -> dict:
+    """Builds the upsert of the receipts collection that records a view, for view_post
+
+    It is a single upsert, so that opening a post costs one write. It only inserts, so a response
+    that was recorded first (see respond_post) is never overwritten.
+
+    Args:
+        username: A string representing the username of the user
+        post: A dictionary object that represents the post, with "_id" and
+            "requires_acknowledgement"
+
+    Returns:
+        A dictionary containing the keyword arguments of update_one
+    """
+    receipt = {
+        "response": None,
+        "date_viewed": int(round(time())),
+        "date_modified": int(time() * 1000),
+    }
+    if badges.BADGES:  # Remember whether this view made the post pending, for respond_post
+        receipt["pending"] = view_pending(post)
+    return {
+        "filter": {"post_id": post["_id"], "username": username},
+        "update": {"$setOnInsert": receipt},
+        "upsert": True,
+    }
+
+
+def view_pending(post: dict):
+    """Gets whether a first view of a post leaves a response pending, as stored in its receipt
+
+    Args:
+        post: A dictionary object that represents the post, with "requires_acknowledgement"
+
+    Returns:
+        A boolean value, or None if BADGES is disabled, in which case it is not stored
+    """
+    return bool(post["requires_acknowledgement"]) if badges.BADGES else None
+
+
+def view_writes(username: str, post: dict) -> dict:
+    """Builds the writes that follow a view recorded by view_upsert
+
+    Args:
+        username, post: See view_upsert
+
+    Returns:
+        A dictionary of writes, see receipt_writes
+    """
+    return receipt_writes(
+        username,
+        {(post["_id"], username): {}},
+        {"unviewed": -1, "pending": int(bool(post["requires_acknowledgement"]))},
+    )
+
+
+def respond_post(username: str, post_id: str, response: bool):
+    """Indicate the response by a user to a post
+
+    Args:
+        username: A string representing the username of the user
+        post_id: A string representing the post id of the post the user responded to
+        response: A boolean value representing the response by the user
+
+    Returns:
+        A boolean value indicating if the submitting of the response was successful, which is
+        False if the post does not exist. If write-behind buffering is enabled, the response is
+        only queued, and True is returned
+    """
+    if db["posts"].find_one({"_id": ObjectId(post_id)}, {"_id": 1}) is None:
+        return False  # Receipts are never written for deleted or unknown posts
+    if receipt_buffer:
+        receipt_buffer.respond(username, ObjectId(post_id), response)
+        return True
+    before = db["receipts"].find_one_and_update(**response_upsert(username, post_id, response))
+    changed, writes = response_writes(username, post_id, response, before)
+    write_all(writes)
+    return changed
+
+
+def response_upsert(username: str, post_id: str, response: bool) -> dict:
+    """Builds the upsert of the receipts collection that records a response, for respond_post
+
+    Responding implies viewing, so the receipt is created if view_post has not done so yet.
+
+    Args:
+        username, post_id, response: See respond_post
+
+    Returns:
+        A dictionary containing the keyword arguments of find_one_and_update, which returns the
+        receipt as it was before, or None
+    """
+    return {
+        "filter": {"post_id": ObjectId(post_id), "username": username},
+        "update": {
+            "$set": {"response": response, "pending": False, "date_modified": int(time() * 1000)},
+            "$setOnInsert": {"date_viewed": int(round(time()))},
+        },
+        "projection": {"_id": 0, "response": 1, "pending": 1},
+        "upsert": True,
+        "return_document": pymongo.ReturnDocument.BEFORE,
+    }
+
+
+def response_writes(username: str, post_id: str, response: bool, before: dict) -> tuple:
+    """Builds the writes that follow a response recorded by response_upsert
+
+    Args:
+        username, post_id, response: See respond_post
+        before: A dictionary representing the receipt before the response, or None
+
+    Returns:
+        A tuple containing:
+            - a boolean value indicating if the response changed the receipt
+            - a dictionary of writes, see receipt_writes
+    """
+    changed = before is None or before.get("response") != response
+    deltas = {}
+    if before is None:  # Not viewed before
+        deltas["unviewed"] = -1
+    elif before.get("pending") and before.get("response") is None:
+        deltas["pending"] = -1
+    events = {(ObjectId(post_id), username): {"response": response}} if changed else {}
+    return changed, receipt_writes(username, events, deltas)
+
+
+def receipt_writes(username: str, events: dict, deltas: dict) -> dict:
+    """Builds the writes that update the data derived from a user's receipts
+
+    These are the user's version stamp (see versions.bump_versions), and, if enabled, the user's
+    inbox entries and to-do counters. They are returned rather than written, so that asyncapi.py
+    can write them with motor.
+
+    Args:
+        username: A string representing the username of the user
+        events: A dictionary in the form of {(post_id, username): event} of the receipts that
+            changed, see inbox.update_inbox
+        deltas: A dictionary in the form of {"unviewed": int, "pending": int}, the changes of the
+            user's to-do counters, where either count may be left out
+
+    Returns:
+        A dictionary in the form of {collection: requests}, where requests is a list of
+        pymongo write operations, for write_all
+    """
+    writes = {}
+    if events:
+        writes["versions"] = versions.version_requests(users=[username])
+        if inbox.INBOX:
+            writes["inbox"] = inbox.inbox_requests(events)
+    if badges.BADGES and any(deltas.values()):
+        writes["badges"] = badges.badge_requests({username: deltas})
+    return writes
+
+
+def write_all(writes: dict):
+    """Runs writes built by receipt_writes
+
+    Args:
+        writes: A dictionary in the form of {collection: requests}
+    """
+    for collection, requests in writes.items():
+        db[collection].bulk_write(requests, ordered=False)
+
+
+def apply_receipts(username: str, operations: list) -> list:
+    """Applies many views and responses of a user at once
+
+    This has the same effect as calling view_post and respond_post for every operation, in order,
+    but reads the posts and the user's receipts once and writes all receipts with one bulk_write.
+
+    Args:
+        username: A string representing the username of the user
+        operations: A list containing dictionaries in the form of {"op": "view", "id": post_id} or
+            {"op": "respond", "id": post_id, "response": response}, where post_id is a string and
+            response is a boolean value
+
+    Returns:
+        A list containing a dictionary for every operation, in the same order, in the form of
+        {"success": True, "changed": changed} or {"success": False, "message": message}. changed
+        is what view_post or respond_post would have returned
+
+    Raises:
+        ValueError: More than BATCH_LIMIT operations
+    """
+    if len(operations) > BATCH_LIMIT:
+        raise ValueError(f"At most {BATCH_LIMIT} operations are accepted")
+
+    results, valid = validate_receipts(operations)
+    post_ids = list({post_id for _, _, post_id, _ in valid})
+    posts = dict(
+        [
+            (post["_id"], post)
+            for post in db["posts"].find(
+                {"_id": {"$in": post_ids}}, {"requires_acknowledgement": 1}
+            )
+        ]
+    )
+    for i, _, post_id, _ in valid:
+        if post_id not in posts:
+            results[i] = {"success": False, "message": "Post not found"}
+    valid = [operation for operation in valid if operation[2] in posts]
+    if receipt_buffer:
+        for i, op, post_id, response in valid:
+            if op == "view":
+                receipt_buffer.view(username, post_id, view_pending(posts[post_id]))
+            else:
+                receipt_buffer.respond(username, post_id, response)
+            results[i] = {"success": True, "changed": True}
+        return results
+
+    receipts = dict(
+        [
+            (receipt["post_id"], receipt)
+            for receipt in db["receipts"].find(
+                {"post_id": {"$in": post_ids}, "username": username},
+                {"_id": 0, "post_id": 1, "response": 1, "pending": 1},
+            )
+        ]
+    )
+    responses, events, deltas = replay_receipts(username, valid, posts, receipts, results)
+    if responses:
+        db["receipts"].bulk_write(receipt_requests(username, responses, posts), ordered=False)
+    write_all(receipt_writes(username, events, deltas))
+    return results
+
+
+def validate_receipts(operations: list) -> tuple:
+    """Validates the operations of apply_receipts
+
+    Args:
+        operations: See apply_receipts
+
+    Returns:
+        A tuple containing:
+            - a list containing the result of every operation, see apply_receipts, which is None
+              for the valid operations
+            - a list containing tuples in the form of (index, op, post_id, response) for the
+              valid operations, where post_id is an ObjectId
+    """
+    results = [None] * len(operations)
+    valid = []
+    for i, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("op") not in ("view", "respond"):
+            results[i] = {"success": False, "message": "Invalid operation"}
+        elif not ObjectId.is_valid(operation.get("id")):
+            results[i] = {"success": False, "message": "Invalid post id"}
+        elif operation["op"] == "respond" and not isinstance(operation.get("response"), bool):
+            results[i] = {"success": False, "message": "Invalid response"}
+        else:
+            valid.append((i, operation["op"], ObjectId(operation["id"]), operation.get("response")))
+    return results, valid
+
+
+def replay_receipts(username: str, valid: list, posts: dict, receipts: dict, results: list):
+    """Replays the operations of apply_receipts on the user's receipts, as view_post and
+    respond_post would, and sets their results
+
+    Args:
+        username: A string representing the username of the user
+        valid: A list containing the valid operations of existing posts, see validate_receipts
+        posts: A dictionary in the form of {post_id: post}, with "requires_acknowledgement"
+        receipts: A dictionary in the form of {post_id: receipt} of the user's receipts, with
+            "response" and "pending", which is updated
+        results: A list containing the result of every operation, which is updated
+
+    Returns:
+        A tuple containing:
+            - a dictionary in the form of {post_id: response, or None for views only}, of the
+              receipts to write, see receipt_requests
+            - a dictionary in the form of {(post_id, username): event}, see receipt_writes
+            - a dictionary in the form of {"unviewed": int, "pending": int}, see receipt_writes
+    """
+    responses, events = {}, {}
+    deltas = {"unviewed": 0, "pending": 0}
+    for i, op, post_id, response in valid:
+        before = receipts.get(post_id)
+        if op == "view":
+            changed = before is None
+            if changed:
+                pending = bool(posts[post_id]["requires_acknowledgement"])
+                receipts[post_id] = {"response": None, "pending": pending}
+                deltas["unviewed"] -= 1
+                deltas["pending"] += int(pending)
+                events.setdefault((post_id, username), {})
+                responses.setdefault(post_id, None)
+        else:
+            changed = before is None or before.get("response") != response
+            if before is None:
+                deltas["unviewed"] -= 1
+            elif before.get("pending") and before.get("response") is None:
+                deltas["pending"] -= 1
+            receipts[post_id] = {"response": response, "pending": False}
+            if changed:
+                events[(post_id, username)] = {"response": response}
+            responses[post_id] = response
+        results[i] = {"success": True, "changed": changed}
+    return responses, events, deltas
+
+
+def receipt_requests(username: str, responses: dict, posts: dict) -> list:
+    """Builds the writes of the receipts collection of apply_receipts
+
+    These are the upserts of view_post and respond_post (see view_upsert and response_upsert).
+
+    Args:
+        username: A string representing the username of the user
+        responses: A dictionary in the form of {post_id: response, or None for views only}
+        posts: A dictionary in the form of {post_id: post}, with "requires_acknowledgement"
+
+    Returns:
+        A list containing pymongo.UpdateOne objects, for a bulk_write on the receipts collection
+    """
+    requests = []
+    for post_id, response in responses.items():
+        if response is None:
+            upsert = view_upsert(username, posts[post_id])
+        else:
+            upsert = response_upsert(username, post_id, response)
+        requests.append(pymongo.UpdateOne(upsert["filter"], upsert["update"], upsert=True))
+    return requests
+
+
+def receipts_flushed(events: dict):
+    """Updates the data derived from receipts, after buffered receipts are written
+
+    The to-do counters change as in view_post and respond_post, from whether the flush created
+    each receipt and, for responses, the receipt as it was before (see WriteBehindBuffer).
+
+    Args:
+        events: A dictionary in the form of {(post_id, username): event}, see inbox.update_inbox and
+            WriteBehindBuffer
+    """
+    versions.bump_versions(users={username for _, username in events})
+    if inbox.INBOX:
+        inbox.update_inbox(events)
+    if badges.BADGES:
+        deltas = {}
+        for (_, username), event in events.items():
+            delta = deltas.setdefault(username, {"unviewed": 0, "pending": 0})
+            before = event.get("before") or {}
+            if event["inserted"]:
+                delta["unviewed"] -= 1
+                if "response" not in event:
+                    delta["pending"] += int(bool(event.get("pending")))
+            elif "response" in event and before.get("pending") and before.get("response") is None:
+                delta["pending"] -= 1
+        badges.increment_badges(deltas)
+
+
+def buffered_receipts(username: str) -> tuple:
+    """Gets the views and responses of a user that are waiting in the write-behind buffer
+
+    The user's version is only bumped when they are flushed, so they are part of the entity tag
+    of the feed, which then changes as soon as the user views or responds to a post.
+
+    Args:
+        username: A string representing the username of the user
+
+    Returns:
+        A tuple containing tuples in the form of (post_id, response), sorted by post_id, where
+        response is "viewed" if the user has not responded. It is empty if buffering is disabled
+    """
+    if not receipt_buffer:
+        return ()
+    return tuple(
+        sorted(
+            (str(post_id), entry.get("response", "viewed"))
+            for post_id, entry in receipt_buffer.pending_for(username).items()
+        )
+    )
@@ -0,0 +1,61 @@
+"""On-demand request profiling for app.py
+
+A request is run under cProfile if it carries the token in the PROFILE_TOKEN environment variable,
+either in the X-Profile header or in the profile query parameter. The profile is saved as a pstats
+file in PROFILE_DIR, which can be read with the pstats module or tools such as snakeviz, and its
+name is returned in the X-Profile-File response header. If PROFILE_TOKEN is not set, profiling is
+disabled, and checking for it costs one comparison per request.
+"""
+import cProfile
+import os
+import re
+import tempfile
+from secrets import compare_digest
+from time import time
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles"))
+
+
+def requested(header: str, parameter: str) -> bool:
+    """Checks whether a request asked to be profiled
+
+    Args:
+        header: A string representing the value of the X-Profile header, or None
+        parameter: A string representing the value of the profile query parameter, or None
+
+    Returns:
+        A boolean value indicating whether profiling is enabled and the request carries the token
+    """
+    if not PROFILE_TOKEN:
+        return False
+    token = header or parameter
+    return token is not None and compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def start() -> cProfile.Profile:
+    """Starts profiling the current thread
+
+    Returns:
+        A cProfile.Profile object, to be passed to stop
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop(profile: cProfile.Profile, route: str) -> str:
+    """Stops profiling and saves the profile
+
+    Args:
+        profile: A cProfile.Profile object, from start
+        route: A string representing the route of the request, used in the file name
+
+    Returns:
+        A string representing the name of the pstats file, in PROFILE_DIR
+    """
+    profile.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{int(time() * 1000)}-{os.getpid()}{re.sub(r'[^A-Za-z0-9]+', '-', route)}.pstats"
+    profile.dump_stats(os.path.join(PROFILE_DIR, name))
+    return name
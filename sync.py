@@ -0,0 +1,321 @@
+"""Changes to feeds, for /api/posts/sync and /api/posts/stream
+
+get_changes returns the changes to a user's feed since a sync token. Posts deleted from a user's
+groups, and groups deleted or left, are logged as deletions, and additions to groups as
+memberships, so that it can return tombstones and the posts of joined groups. Both logs expire
+after DELETIONS_TTL seconds (see indexes.py). The posts written by this process are also
+published to post_events, for the stream (see broker.py).
+"""
+import base64
+import datetime
+import os
+from time import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+import feed
+import receipts
+from broker import Broker
+from database import db
+
+# Seconds that deletions and memberships are kept for, as the tombstones and joined groups of
+# get_changes (see the TTL indexes of indexes.py)
+DELETIONS_TTL = int(os.getenv("DELETIONS_TTL", str(90 * 86400)))
+SYNC_LIMIT = 200  # Largest number of posts returned by one call to get_changes
+
+# Milliseconds that sync tokens look back, for writes stamped by other processes (or read from a
+# lagging secondary) that become visible after later ones
+SYNC_LAG = int(os.getenv("SYNC_LAG", "5000"))
+
+# Events of posts written by this process, for /api/posts/stream (see broker.py)
+post_events = Broker()
+
+
+def log_deletion(post_id=None, group_id=None, usernames=None):
+    """Records a deletion, for get_changes to report as a tombstone
+
+    A deletion is either of a post from a group (post_id and group_id), or of a group's posts
+    for some users, because the group was deleted or the users were removed from it (group_id
+    and usernames). It is also published to post_events, for /api/posts/stream.
+
+    Args:
+        post_id: An ObjectId representing the id of the deleted post. Defaults to None
+        group_id: An ObjectId representing the id of the group. Defaults to None
+        usernames: A list containing strings that represent the usernames of the users that
+            lost access to the group. Defaults to None
+    """
+    if post_id is None and not usernames:
+        return
+    if post_id is not None:
+        post_events.publish_threadsafe("post_deleted", group_id, post_id)
+    else:
+        post_events.publish_threadsafe("group_removed", group_id, usernames=usernames)
+    entry = {
+        "group_id": group_id,
+        "date_deleted": int(time() * 1000),
+        "deleted_at": datetime.datetime.now(datetime.timezone.utc),  # For the TTL index
+    }
+    if post_id is not None:
+        entry["post_id"] = post_id
+    else:
+        entry["usernames"] = usernames
+    db["deletions"].insert_one(entry)
+
+
+def log_membership(group_id, usernames: list):
+    """Records that users were added to a group, for get_changes to return the group's posts
+
+    Args:
+        group_id: An ObjectId representing the id of the group
+        usernames: A list containing strings that represent the usernames of the users added
+    """
+    if usernames:
+        db["memberships"].insert_one(
+            {
+                "group_id": group_id,
+                "usernames": usernames,
+                "date_added": int(time() * 1000),
+                "added_at": datetime.datetime.now(datetime.timezone.utc),  # For the TTL index
+            }
+        )
+
+
+def encode_sync_token(timestamp: int, post_id=None, floor: int = None) -> str:
+    """Encodes a position in the changes of a feed as an opaque sync token
+
+    Args:
+        timestamp: An integer representing the time, in milliseconds since the epoch
+        post_id: An ObjectId representing the id of the last post returned with that change time,
+            or None for every change from that time on. Defaults to None
+        floor: An integer representing the time that the sync that returned post_id started from,
+            see get_changes, or None. Defaults to None
+
+    Returns:
+        A string representing the sync token
+    """
+    position = str(timestamp) if post_id is None else f"{timestamp}:{post_id}:{floor}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_sync_token(token: str) -> tuple:
+    """Decodes a sync token made by encode_sync_token
+
+    Args:
+        token: A string representing the sync token
+
+    Returns:
+        A tuple containing:
+            - an integer representing the time, in milliseconds since the epoch
+            - an ObjectId representing the id of the last post returned with that change time,
+                or None
+            - an integer representing the time the sync started from, or None
+
+    Raises:
+        ValueError: Invalid sync token
+    """
+    try:
+        parts = base64.urlsafe_b64decode(token.encode()).decode().split(":")
+        if len(parts) > 3:
+            raise ValueError("Too many parts")
+        timestamp, post_id, floor = parts + [None] * (3 - len(parts))
+        return (
+            int(timestamp),
+            ObjectId(post_id) if post_id else None,
+            int(floor) if floor and floor != "None" else None,
+        )
+    except (ValueError, UnicodeDecodeError, InvalidId) as error:
+        raise ValueError("Invalid sync token") from error
+
+
+def get_changes(username: str, since: str = None) -> dict:
+    """Gets the changes to a user's feed since a sync token
+
+    Changed posts are posts created or updated since the token, posts whose receipt of the user
+    changed since the token, and every post of the groups the user was added to since the token.
+    They are returned in the order of their change time, the later of the two (or the time the
+    user was added), so that the token of a partial result points after the last post returned.
+    Tombstones are posts deleted or moved out of the user's groups, and groups deleted or left,
+    since the token. They are only kept for DELETIONS_TTL seconds (see indexes.py), so older
+    tokens are refused, and a first sync, which returns every post, has none.
+
+    Changes are stamped by the clock of the process that wrote them, and may only be visible
+    later, so the token of a complete result is SYNC_LAG milliseconds before the sync started,
+    and the next sync returns the changes of that time again. Clients already have the posts
+    returned twice, which they replace by _id.
+
+    Args:
+        username: A string representing the username of the user
+        since: A string representing the sync token returned by the previous call, or None to
+            get every post. Defaults to None
+
+    Returns:
+        A dictionary containing:
+            "data": a list containing dictionary objects that represent a post, like
+                helper.get_posts, oldest change first, with at most SYNC_LIMIT posts;
+            "tombstones": a list containing dictionaries in the form of {"post_id": id} or
+                {"group_id": id}, for posts or whole groups to remove;
+            "since": a string representing the sync token for the next call;
+            "more": a boolean value indicating if there are more changes to fetch right away
+
+    Raises:
+        ValueError: Invalid sync token, or sync token expired
+    """
+    timestamp, after_id, floor = decode_sync_token(since) if since else (0, None, None)
+    now = int(time() * 1000)
+    if since and timestamp < now - DELETIONS_TTL * 1000:
+        raise ValueError("Sync token expired")
+    if floor is None:  # The first call of this sync, rather than the next page of one
+        floor = now - SYNC_LAG
+    groups = feed.group_ids_with_user(username)
+    posts = list(
+        db.feed_collection("posts").aggregate(
+            sync_stages(username, groups, timestamp if since else None, after_id)
+        )
+    )
+    if receipts.receipt_buffer:
+        receipts.receipt_buffer.overlay(username, posts)
+
+    more = len(posts) == SYNC_LIMIT
+    if more:  # Continue right after the last post returned, instead of skipping the rest
+        token = encode_sync_token(posts[-1]["changed"], posts[-1]["_id"], floor)
+    else:
+        token = encode_sync_token(floor)
+    for post in posts:
+        del post["changed"]
+    return {
+        "data": feed.format_posts(posts),
+        "tombstones": sync_tombstones(username, groups, timestamp) if since else [],
+        "since": token,
+        "more": more,
+    }
+
+
+def sync_stages(username: str, group_ids: list, since: int = None, after_id=None) -> list:
+    """Builds the aggregation stages of get_changes, on the posts collection
+
+    Args:
+        username: A string representing the username of the user
+        group_ids: A list containing ObjectIds that represent the ids of the user's groups
+        since: An integer representing the time of the sync token, in milliseconds since the
+            epoch, or None for a first sync. Defaults to None
+        after_id: An ObjectId representing the id of the last post returned at that time, or
+            None. Defaults to None
+
+    Returns:
+        A list containing the aggregation stages
+    """
+    query = {"group_id": {"$in": group_ids}}
+    joined = {}
+    if since is not None:
+        joined = groups_joined(username, group_ids, since)
+        changed_receipts = [
+            receipt["post_id"]
+            for receipt in db["receipts"].find(
+                {"username": username, "date_modified": {"$gte": since}},
+                {"_id": 0, "post_id": 1},
+            )
+        ]
+        query["$or"] = [
+            {"date_modified": {"$gte": since}},
+            {"_id": {"$in": changed_receipts}},
+            {"group_id": {"$in": list(joined)}},
+        ]
+    stages = [{"$match": query}] + feed.receipt_stages(username, changed=True)
+    if joined:  # The posts of a group the user was added to changed when they were added
+        added = {
+            "$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$group_id", group_id]}, "then": date_added}
+                    for group_id, date_added in joined.items()
+                ],
+                "default": 0,
+            }
+        }
+        stages.append({"$addFields": {"changed": {"$max": ["$changed", added]}}})
+    since = since or 0
+    if after_id is None:
+        position = {"changed": {"$gte": since}}
+    else:
+        position = {
+            "$or": [{"changed": {"$gt": since}}, {"changed": since, "_id": {"$gt": after_id}}]
+        }
+    return stages + [
+        {"$match": position},
+        {"$sort": {"changed": 1, "_id": 1}},
+        {"$limit": SYNC_LIMIT},
+    ]
+
+
+def groups_joined(username: str, group_ids: list, since: int) -> dict:
+    """Finds the groups a user was added to since a time, and is still in, for get_changes
+
+    Args:
+        username: A string representing the username of the user
+        group_ids: A list containing ObjectIds that represent the ids of the user's groups
+        since: An integer representing the time, in milliseconds since the epoch
+
+    Returns:
+        A dictionary in the form of {group_id: date_added}, with the latest time the user was
+        added to each group, in milliseconds since the epoch
+    """
+    joined = {}
+    for membership in db["memberships"].find(
+        {"usernames": username, "date_added": {"$gte": since}, "group_id": {"$in": group_ids}},
+        {"group_id": 1, "date_added": 1},
+    ):
+        joined[membership["group_id"]] = max(
+            joined.get(membership["group_id"], 0), membership["date_added"]
+        )
+    return joined
+
+
+def sync_tombstones(username: str, group_ids: list, since: int) -> list:
+    """Finds the posts and groups removed from a user's feed since a time, for get_changes
+
+    Posts moved to another of the user's groups, and groups the user was added to again, are
+    still in the feed, so they have no tombstone.
+
+    Args:
+        username: A string representing the username of the user
+        group_ids: A list containing ObjectIds that represent the ids of the user's groups
+        since: An integer representing the time, in milliseconds since the epoch
+
+    Returns:
+        A list containing dictionaries in the form of {"post_id": id} or {"group_id": id}
+    """
+    post_ids, removed_groups = [], []
+    for deletion in db["deletions"].find(tombstone_filter(username, group_ids, since)):
+        if "post_id" in deletion:
+            post_ids.append(deletion["post_id"])
+        elif deletion["group_id"] not in group_ids:
+            removed_groups.append(deletion["group_id"])
+    if post_ids:
+        visible = {
+            post["_id"]
+            for post in db["posts"].find(
+                {"_id": {"$in": post_ids}, "group_id": {"$in": group_ids}}, {"_id": 1}
+            )
+        }
+        post_ids = [post_id for post_id in post_ids if post_id not in visible]
+    return [{"post_id": post_id} for post_id in dict.fromkeys(post_ids)] + [
+        {"group_id": group_id} for group_id in dict.fromkeys(removed_groups)
+    ]
+
+
+def tombstone_filter(username: str, group_ids: list, since: int) -> dict:
+    """Builds the filter of sync_tombstones, on the deletions collection
+
+    Args:
+        See sync_tombstones
+
+    Returns:
+        A dictionary representing the filter
+    """
+    return {
+        "date_deleted": {"$gte": since},
+        "$or": [
+            {"group_id": {"$in": group_ids}, "post_id": {"$exists": True}},
+            {"usernames": username},
+        ],
+    }
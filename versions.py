@@ -0,0 +1,92 @@
+# pylint: disable=consider-using-dict-comprehension
+"""Version stamps of users and groups, for the entity tags of feeds
+
+A user's version changes when their own views or responses change, and a group's version changes
+when its posts or the group itself change. helper.feed_etag hashes them into the entity tag of a
+feed, and helper.search_post_ids keys its cache on them.
+"""
+import hashlib
+
+import pymongo
+
+from database import db
+
+def bump_versions(users=(), groups=()):
+    """Increments the version stamps of users and groups
+
+    A user's version changes when their own views or responses change, and a group's version
+    changes when its posts or the group itself change. Together they identify the state of a
+    user's feed (see helper.feed_etag).
+
+    Args:
+        users: An iterable of strings representing the usernames of the users. Defaults to ()
+        groups: An iterable of ObjectIds representing the ids of the groups. Defaults to ()
+    """
+    requests = version_requests(users, groups)
+    if requests:
+        db["versions"].bulk_write(requests, ordered=False)
+
+
+def version_requests(users=(), groups=()) -> list:
+    """Builds the writes that increment the version stamps of users and groups
+
+    Args:
+        users, groups: See bump_versions
+
+    Returns:
+        A list containing pymongo.UpdateOne objects, for a bulk_write on the versions collection
+    """
+    keys = [f"user:{username}" for username in users] + [f"group:{group}" for group in groups]
+    return [
+        pymongo.UpdateOne({"_id": key}, {"$inc": {"version": 1}}, upsert=True) for key in keys
+    ]
+
+
+def read_versions(keys: list) -> dict:
+    """Reads version stamps, with the read preference of the feed queries
+
+    The versions are read before the feed, from the same kind of member, so that they never
+    describe a later state than the posts returned with them, even when the feed is read from a
+    lagging secondary (see database.py). A stale feed then has a stale entity tag, which changes
+    when the secondary catches up, instead of being kept by clients as up to date.
+
+    Args:
+        keys: A list containing strings that represent the keys, see version_keys
+
+    Returns:
+        A dictionary in the form of {key: version}, without the keys never bumped
+    """
+    return dict(
+        [
+            (doc["_id"], doc["version"])
+            for doc in db.feed_collection("versions").find({"_id": {"$in": keys}})
+        ]
+    )
+
+
+def version_keys(username: str, group_ids: list) -> list:
+    """Gets the keys of the version stamps that a user's feed depends on
+
+    Args:
+        username: A string representing the username of the user
+        group_ids: A list containing ObjectIds that represent the ids of the user's groups
+
+    Returns:
+        A list containing strings that represent the _id of the stamps in the versions collection
+    """
+    return [f"user:{username}"] + sorted(f"group:{group_id}" for group_id in group_ids)
+
+
+def hash_versions(keys: list, versions: dict, params) -> str:
+    """Hashes version stamps and request parameters into an entity tag
+
+    Args:
+        keys: A list containing strings that represent the keys of the stamps, from version_keys
+        versions: A dictionary in the form of {key: version}. Missing keys count as version 0
+        params: A tuple containing the parameters of the request
+
+    Returns:
+        A string representing the entity tag
+    """
+    state = "|".join([f"{key}={versions.get(key, 0)}" for key in keys] + [repr(params)])
+    return hashlib.sha1(state.encode()).hexdigest()
@@ -0,0 +1,239 @@
+"""Write-behind buffering of receipts for helper.py
+
+This module merges the view and respond events of students in memory, and writes them to the
+receipts collection in batches, instead of one update per request. It is enabled in helper.py by
+setting the WRITE_BEHIND environment variable.
+"""
+import atexit
+import threading
+from time import perf_counter, time
+
+import pymongo
+
+VIEW_FIELDS = ("date_viewed", "date_modified", "pending")  # Fields of the receipt of a view
+
+
+class WriteBehindBuffer:  # pylint: disable=too-many-instance-attributes
+    """Buffers receipt writes and flushes them with bulk_write
+
+    Events are keyed by (post_id, username), so repeated views are merged, and a response
+    replaces an earlier pending view. The buffer is flushed from a background thread every
+    interval seconds, and as soon as it holds max_size events, so that the request that filled it
+    does not wait for the write. It is also flushed when the process exits.
+
+    Attributes:
+        database: The database to write to, in which receipts are stored in db["receipts"]
+        max_size: An integer representing the number of pending events that triggers a flush
+        interval: A float representing the number of seconds between background flushes
+        on_flush: A function that is called with the events written, in the form of
+            {(post_id, username): event}, after every successful flush, or None. Every event
+            contains "inserted", a boolean value indicating if the flush created the receipt
+        read_before: A boolean value indicating if the receipts that responses change are read
+            before they are written. If so, the events of responses contain "before", the
+            receipt as it was, with "response" and "pending", or None
+    """
+
+    def __init__(
+        self,
+        database,
+        max_size: int = 500,
+        interval: float = 1.0,
+        on_flush=None,
+        read_before: bool = False,
+    ):
+        self.database = database
+        self.max_size = max_size
+        self.interval = interval
+        self.on_flush = on_flush
+        self.read_before = read_before
+        # {(post_id, username): {"date_viewed", "date_modified", "response", "pending"}}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._full = threading.Event()
+        self._thread = None
+        self._stats = {"flushes": 0, "writes": 0, "errors": 0, "last_flush_seconds": 0.0}
+
+    def view(self, username: str, post_id, pending: bool = None):
+        """Records that a user has viewed a post
+
+        Args:
+            username: A string representing the username of the user
+            post_id: An ObjectId representing the id of the post
+            pending: A boolean value indicating if the view leaves a response pending, stored in
+                the receipt if it is created, or None not to store it. Defaults to None
+        """
+        entry = {"date_viewed": int(round(time())), "date_modified": int(time() * 1000)}
+        if pending is not None:
+            entry["pending"] = pending
+        with self._lock:
+            self._pending.setdefault((post_id, username), entry)
+        self._after_add()
+
+    def respond(self, username: str, post_id, response: bool):
+        """Records the response of a user to a post
+
+        Args:
+            username: A string representing the username of the user
+            post_id: An ObjectId representing the id of the post
+            response: A boolean value representing the response by the user
+        """
+        with self._lock:
+            entry = self._pending.setdefault(
+                (post_id, username), {"date_viewed": int(round(time()))}
+            )
+            entry["response"] = response
+            entry["date_modified"] = int(time() * 1000)
+        self._after_add()
+
+    def pending_for(self, username: str) -> dict:
+        """Gets the pending events of a user
+
+        Args:
+            username: A string representing the username of the user
+
+        Returns:
+            A dictionary in the form of {post_id: entry}, where entry is a dictionary that
+            contains "response" if the user has responded
+        """
+        with self._lock:
+            return {
+                post_id: dict(entry)
+                for (post_id, username_), entry in self._pending.items()
+                if username_ == username
+            }
+
+    def overlay(self, username: str, posts: list) -> list:
+        """Applies the pending events of a user to posts read from the database
+
+        This lets users see their own views and responses before they are flushed.
+
+        Args:
+            username: A string representing the username of the user
+            posts: A list containing dictionary objects that represent a post, with "viewed" and
+                "acknowledged" set for the user
+
+        Returns:
+            The same list, with the pending events applied
+        """
+        pending = self.pending_for(username)
+        for post in posts:
+            if post["_id"] in pending:
+                post["viewed"] = True
+                if "response" in pending[post["_id"]]:
+                    post["acknowledged"] = pending[post["_id"]]["response"]
+        return posts
+
+    def flush(self) -> int:
+        """Writes all pending events to the database
+
+        Events that could not be written are put back into the buffer, merged with any newer
+        event for the same post and user.
+
+        Returns:
+            An integer representing the number of events written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            requests = []
+            for (post_id, username), entry in pending.items():
+                if "response" in entry:
+                    update = {
+                        "$set": {
+                            "response": entry["response"],
+                            "pending": False,
+                            "date_modified": entry["date_modified"],
+                        },
+                        "$setOnInsert": {"date_viewed": entry["date_viewed"]},
+                    }
+                else:
+                    receipt = {field: entry[field] for field in VIEW_FIELDS if field in entry}
+                    update = {"$setOnInsert": dict(receipt, response=None)}
+                requests.append(
+                    pymongo.UpdateOne(
+                        {"post_id": post_id, "username": username}, update, upsert=True
+                    )
+                )
+
+            start = perf_counter()
+            try:
+                before = self._read_before(pending) if self.read_before else {}
+                result = self.database["receipts"].bulk_write(requests, ordered=False)
+            except pymongo.errors.PyMongoError:
+                with self._lock:
+                    for key, entry in pending.items():
+                        current = self._pending.setdefault(key, entry)
+                        if "response" in entry and "response" not in current:
+                            current["response"] = entry["response"]
+                    self._stats["errors"] += 1
+                return 0
+            finally:
+                self._stats["last_flush_seconds"] = perf_counter() - start
+
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["writes"] += len(requests)
+            inserted = set(result.upserted_ids)  # Indexes of the requests, in pending's order
+            for i, (key, entry) in enumerate(pending.items()):
+                entry["inserted"] = i in inserted
+                if "response" in entry and self.read_before:
+                    entry["before"] = before.get(key)
+            if self.on_flush:
+                try:
+                    self.on_flush(pending)
+                except pymongo.errors.PyMongoError:
+                    with self._lock:
+                        self._stats["errors"] += 1
+            return len(requests)
+
+    def stats(self) -> dict:
+        """Gets statistics of the buffer
+
+        Returns:
+            A dictionary containing "depth" (number of pending events), "flushes", "writes",
+            "errors" and "last_flush_seconds"
+        """
+        with self._lock:
+            return dict(self._stats, depth=len(self._pending))
+
+    def close(self):
+        """Stops the background thread and flushes the remaining events"""
+        self._stopped.set()
+        self._full.set()
+        self.flush()
+
+    def _read_before(self, pending: dict) -> dict:
+        keys = [key for key, entry in pending.items() if "response" in entry]
+        if not keys:
+            return {}
+        receipts = self.database["receipts"].find(
+            {"$or": [{"post_id": post_id, "username": username} for post_id, username in keys]},
+            {"_id": 0, "post_id": 1, "username": 1, "response": 1, "pending": 1},
+        )
+        return {(receipt["post_id"], receipt["username"]): receipt for receipt in receipts}
+
+    def _after_add(self):
+        if self._thread is None:
+            self._start()
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._full.wait(self.interval)
+            self._full.clear()
+            if not self._stopped.is_set():
+                self.flush()